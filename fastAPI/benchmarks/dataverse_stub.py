@@ -0,0 +1,70 @@
+import json
+import socket
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI
+from sqlalchemy import create_engine, text
+
+# local stand-in for the Dataverse search API (GET /api/search), answering in the same format
+# from a catalog database, so the Dataverse client can be measured without the network
+
+COLUMNS = ["title", "titleEng", "genre", "synopsis", "openDate", "runningTimeMinute", "actors", "directors",
+           "producer", "distributor", "keywords", "posterUrl", "vodUrl"]
+JSON_COLUMNS = {"genre", "synopsis", "actors", "directors", "producer", "distributor", "keywords", "posterUrl", "vodUrl"}
+
+# Dataverse dataset items of the movies of a catalog database
+def items_from_db(url: str, limit: int = None):
+    engine = create_engine(url)
+    sql = "SELECT id, " + ", ".join(f'"{column}"' for column in COLUMNS) + " FROM movies ORDER BY id"
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+    items = []
+    with engine.connect() as conn:
+        for row in conn.execute(text(sql)):
+            description = {column: (json.loads(value) if column in JSON_COLUMNS and value else value)
+                           for column, value in zip(COLUMNS, row[1:])}
+            items.append({"type": "dataset", "name": description["title"], "global_id": f"doi:10.0/STUB/{row[0]}",
+                          "description": json.dumps(description, ensure_ascii=False)})
+    engine.dispose()
+    return items
+
+# subtree -> items
+def build_app(subtrees: dict):
+    app = FastAPI()
+
+    @app.get("/api/search")
+    def search(q: str = "*", subtree: str = "movies", start: int = 0, per_page: int = 10, type: str = None):
+        items = subtrees.get(subtree, [])
+        if q != "*":
+            items = [item for item in items if q in item["description"]]
+        return {"status": "OK",
+                "data": {"q": q, "total_count": len(items), "start": start,
+                         "items": items[start:start + per_page], "count_in_response": len(items[start:start + per_page])}}
+
+    return app
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# the stub served by uvicorn in a background thread
+class StubServer:
+    def __init__(self, subtrees: dict):
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.server = uvicorn.Server(uvicorn.Config(build_app(subtrees), host="127.0.0.1", port=self.port,
+                                                    log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
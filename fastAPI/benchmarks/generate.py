@@ -0,0 +1,97 @@
+import argparse
+import datetime
+import os
+import random
+import sys
+
+# synthetic catalogs for the benchmarks: Korean titles, genres of schemas.Genre, "YYYY.MM.DD" dates,
+# actor / director / keyword lists, plus a KOBIS style box office CSV naming some of the movies
+# usage: python -m benchmarks.generate --rows 100000 --out bench_100k.db
+
+SYLLABLES = "가나다라마바사아자차카타파하고노도로모보소오조초코토포호구누두루무부수우주추쿠투푸후기니디리미비시이지치키티피히강산바다별달빛꿈밤낮봄여름가을겨울"
+SURNAMES = "김이박최정강조윤장임한오서신권황안송류홍"
+WORDS = ["사랑", "복수", "우주", "가족", "전쟁", "청춘", "비밀", "범죄", "괴물", "시간", "여행", "학교", "도시", "바다", "음악",
+         "형사", "좀비", "첫사랑", "탈출", "재난", "역사", "왕", "친구", "기억", "그림자"]
+ENGLISH = ["Night", "Moon", "Secret", "Road", "City", "Blood", "Love", "Time", "Sea", "Ghost", "King", "Last", "Home", "Dream"]
+
+def korean_name(rng):
+    return rng.choice(SURNAMES) + "".join(rng.choice(SYLLABLES) for _ in range(2))
+
+def korean_title(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(1, 2))]
+    return " ".join(words) + " " + "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 3)))
+
+def movie(rng, number: int, genres: list, actors: list, directors: list):
+    from sql_app import schemas
+
+    open_date = datetime.date(1990, 1, 1) + datetime.timedelta(days=rng.randint(0, 13500))
+    title = f"{korean_title(rng)} {number}"
+    cast = rng.sample(actors, rng.randint(2, 8))
+    keywords = rng.sample(WORDS, rng.randint(0, 4))
+    plot = " ".join(rng.choice(WORDS) + rng.choice(["은", "는", "이", "가", "를"]) for _ in range(40)) + "."
+    return schemas.Movie(
+        title=title,
+        titleEng=" ".join(rng.sample(ENGLISH, 2)) + f" {number}",
+        directors=rng.sample(directors, 1),
+        genre=rng.sample(genres, rng.randint(1, 3)),
+        synopsis={"plotLang": "한국어", "plotText": plot},
+        openDate="" if rng.random() < 0.02 else open_date.strftime("%Y.%m.%d"),
+        runningTimeMinute=f"{rng.randint(70, 180)}분",
+        actors=cast,
+        producer=[f"(주){rng.choice(WORDS)}필름"],
+        distributor=[f"(주){rng.choice(WORDS)}배급"],
+        keywords=keywords,
+        posterUrl=[f"https://example.com/poster/{number}.jpg"],
+        vodUrl=[[f"https://example.com/still/{number}.jpg", f"https://example.com/trailer/{number}.mp4"]],
+    )
+
+def movies(rows: int, seed: int = 0):
+    from sql_app import schemas
+
+    rng = random.Random(seed)
+    genres = [genre.value for genre in schemas.Genre]
+    actors = [korean_name(rng) for _ in range(max(50, rows // 5))]
+    directors = [korean_name(rng) for _ in range(max(20, rows // 20))]
+    for number in range(rows):
+        yield movie(rng, number, genres, actors, directors)
+
+def write_boxoffice(path: str, titles: list):
+    lines = ["■ 일별 박스오피스", "- 조회일: 2023-08-21", "- 출처: 영화진흥위원회 통합전산망 (http://www.kobis.or.kr)",
+             "▶ 검색조건 [ 조회기간: 2023-08-20~2023-08-20 ]", "", "●2023년 08월 20일(Sun)", "순위,영화명,개봉일"]
+    lines += [f"{rank},{title},2023-08-01" for rank, title in enumerate(titles, 1)]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+# build a catalog database at url with the bulk upload path; returns the titles put in the box office file
+def generate(url: str, rows: int, seed: int = 0, boxoffice_file: str = None):
+    os.environ["SQLALCHEMY_DATABASE_URL"] = url
+    from sql_app import crud, migrations
+    from sql_app.database import SessionLocal, engine
+
+    migrations.migrate(engine)
+    db = SessionLocal()
+    titles = []
+    def collect():
+        for number, data in enumerate(movies(rows, seed)):
+            if number % max(1, rows // 30) == 0 and len(titles) < 30:
+                titles.append(data.title)
+            yield data
+    try:
+        report = crud.bulk_insert_movies(db, collect(), batch_size=2000)
+    finally:
+        db.close()
+    if boxoffice_file:
+        write_boxoffice(boxoffice_file, titles)
+    return report, titles
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic movie catalog database")
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--out", default="bench.db")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--boxoffice", default=None, help="also write a KOBIS style CSV here")
+    args = parser.parse_args()
+    if os.path.exists(args.out):
+        sys.exit(f"{args.out} already exists")
+    report, titles = generate(f"sqlite:///{args.out}", args.rows, args.seed, args.boxoffice)
+    print(report)
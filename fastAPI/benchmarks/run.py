@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+# benchmark harness: crud microbenchmarks and end-to-end latency of the main2.py endpoints
+# on a synthetic catalog, with the Dataverse API served by a local stub
+# reports p50 / p99 latency and peak memory; --save stores a baseline, later runs are compared with it
+# usage (from fastAPI/): python -m benchmarks.run --rows 1000 [--save]
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(HERE, "data")
+BASELINE_DIR = os.path.join(HERE, "baselines")
+
+# GET endpoints measured end to end; the destructive ones (/delete_all_records/, /sync/) are left out
+ENDPOINTS = [
+    "/health",
+    "/movies/?q=사랑",
+    "/movies/filter/",
+    "/movies/filter/?genres=액션&genres=드라마&openyear=2000&endyear=2015",
+    "/movies/filter/?q=사랑&page=2",
+    "/movies/filter/?genres=액션&openyear=2000&status=offscreen",
+    "/movies/autocomplete?q=ㄱㅅ",
+    "/movies/facets?genres=액션&openyear=2000&endyear=2015",
+    "/movies/export?genres=액션",
+    "/movies/mostloved/",
+    "/movies/onscreen",
+    "/movies/offscreen?page=10",
+    "/movies/offscreen?page=10&view=card",
+    "/movies/comingsoon",
+    "/movies/detail/{movie_id}",
+    "/movies/detail/{movie_id}/similar",
+    "/cache/stats",
+    "/sync/status",
+    "/metrics",
+]
+
+def percentile(samples: list, fraction: float):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))]
+
+# latency of repeat calls (ms), then one more call under tracemalloc for the peak memory (KiB)
+def measure(function, repeat: int):
+    function()
+    samples = []
+    for _ in range(repeat):
+        began = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - began) * 1000)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"p50_ms": round(statistics.median(samples), 3), "p99_ms": round(percentile(samples, 0.99), 3),
+            "peak_kib": round(peak / 1024, 1)}
+
+def prepare(rows: int):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    db_path = os.path.join(DATA_DIR, f"catalog_{rows}.db")
+    boxoffice_path = os.path.join(DATA_DIR, f"boxoffice_{rows}.csv")
+    os.environ["SQLALCHEMY_DATABASE_URL"] = f"sqlite:///{db_path}"
+    os.environ["BOXOFFICE_FILE"] = boxoffice_path
+    if not os.path.exists(db_path):
+        from . import generate
+        began = time.perf_counter()
+        report, _ = generate.generate(os.environ["SQLALCHEMY_DATABASE_URL"], rows, boxoffice_file=boxoffice_path)
+        print(f"generated {rows} movies in {time.perf_counter() - began:.1f}s: {report}", file=sys.stderr)
+    return db_path
+
+def crud_benchmarks(repeat: int):
+    from sql_app import crud, models
+    from sql_app.database import SessionLocal
+    from .dataverse_stub import items_from_db
+
+    db = SessionLocal()
+    sample = db.query(models.Movie).order_by(models.Movie.id).limit(15).all()
+    actor = sample[0].get_list_field("actors")[0]
+    page = [json.loads(item["description"]) for item in items_from_db(os.environ["SQLALCHEMY_DATABASE_URL"], 15)]
+    first = sample[0]
+    cases = {
+        "search_movies": lambda: crud.search_movies(db, actor),
+        "filtering": lambda: crud.filtering(db, ["액션"], 2000, 2005),
+        "searchquery": lambda: crud.searchquery(db, ["액션", "드라마"], 1995, 2020, 2, 15, None),
+        "searchquery_q": lambda: crud.searchquery(db, None, None, None, 1, 15, "사랑"),
+        "get_movie_match": lambda: crud.get_movie_match(db, first.openDate, first.title, first.runningTimeMinute, first.titleEng),
+        "movies_with_id_data": lambda: crud.movies_with_id_data(page, db),
+    }
+    results = {}
+    for name, function in cases.items():
+        results[name] = measure(lambda: (function(), db.expunge_all()), repeat)
+    db.close()
+    return results
+
+def endpoint_benchmarks(repeat: int):
+    from .dataverse_stub import StubServer, items_from_db
+
+    items = items_from_db(os.environ["SQLALCHEMY_DATABASE_URL"], 2000)
+    with StubServer({"movies": items, "mostloved": items[:60]}) as stub:
+        from fastapi.testclient import TestClient
+        import main2
+        from sql_app import dataverse
+
+        dataverse.client = dataverse.DataverseClient(base_url=stub.url)
+
+        results = {}
+        with TestClient(main2.app) as client:
+            movie_id = client.get("/movies/filter/?per_page=1").json()["data"][0]["id"]
+            for endpoint in ENDPOINTS:
+                url = endpoint.format(movie_id=movie_id)
+                def call():
+                    response = client.get(url)
+                    assert response.status_code < 400, (url, response.status_code)
+                results[endpoint] = measure(call, repeat)
+    return results
+
+def compare(results: dict, baseline: dict, threshold: float):
+    lines = []
+    for group, cases in results.items():
+        for name, stats in cases.items():
+            before = baseline.get(group, {}).get(name)
+            mark = ""
+            if before:
+                ratio = stats["p50_ms"] / max(before["p50_ms"], 1e-6)
+                mark = f"  x{ratio:.2f} vs baseline" + ("  REGRESSION" if ratio > threshold else "")
+            lines.append(f"{group:9} {name:72} p50 {stats['p50_ms']:9.3f}ms  p99 {stats['p99_ms']:9.3f}ms  "
+                         f"peak {stats['peak_kib']:10.1f}KiB{mark}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the crud and endpoint benchmarks")
+    parser.add_argument("--rows", type=int, default=1000, help="catalog size, e.g. 1000, 100000, 1000000")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=1.2, help="p50 ratio reported as a regression")
+    args = parser.parse_args()
+
+    prepare(args.rows)
+    results = {"crud": crud_benchmarks(args.repeat), "endpoint": endpoint_benchmarks(args.repeat)}
+
+    baseline_path = os.path.join(BASELINE_DIR, f"{args.rows}.json")
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    print(compare(results, baseline, args.threshold))
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# the tests run against a throwaway database file; set before sql_app.database is imported
+os.environ["SQLALCHEMY_DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="smdb-tests-"), "test.db")
+os.environ.setdefault("SNAPSHOT_FILE", os.path.join(tempfile.gettempdir(), "smdb-tests-missing.snapshot"))
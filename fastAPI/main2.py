@@ -1,18 +1,29 @@
 from typing import Union
-from fastapi import FastAPI, Query, Depends, FastAPI, HTTPException
-import requests
+from fastapi import FastAPI, Query, Depends, FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 import json
 from sqlalchemy.orm import Session
-from sql_app import crud, models, schemas
+from sql_app import crud, database, dataverse, etag, events, export, metrics, migrations, rebuild, schemas, sync
+from sql_app.search_index import movie_index
+from sql_app.facets import facet_counts
+from sql_app.bitmaps import filter_engine, result_cache
+from sql_app.autocomplete import autocomplete
+from sql_app.similar import similar_movies
+from sql_app.render_cache import render_cache, list_body, cache_for
+from sql_app.boxoffice import boxoffice
+from sql_app.screening import screening, refresh_at_midnight
+from sql_app.snapshot import snapshot_reader, build_snapshot
+from sql_app.schemas import Genre, Status, View
 from sql_app.database import SessionLocal, engine
-import pandas as pd
+import asyncio
 import datetime
 import ast
 from fastapi.middleware.cors import CORSMiddleware
-from enum import Enum
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy import func, Integer, cast, Date
 
-models.Base.metadata.create_all(bind=engine)
+migrations.migrate(engine)
 
 app = FastAPI()
 
@@ -25,13 +36,92 @@ app.add_middleware(
     allow_credentials=True, 
 )
 
+# request / phase latency histograms, see /metrics
+metrics.instrument_engine(engine)
+app.middleware("http")(metrics.timing_middleware)
+metrics.counters["smdb_dataverse_cache"] = ("Dataverse search cache counters", dataverse.search_cache.info)
+metrics.counters["smdb_result_cache"] = ("Filter result cache counters", result_cache.info)
+
+# whole movies are read from the shared catalog snapshot while it is current (sql_app/snapshot.py)
+render_cache.source = snapshot_reader.records
+
+# build the in-memory search index, facet counts, filter bitsets, autocomplete tries and similarity
+# matrix from the database; crud keeps them current afterwards
+# the index, counts and bitsets are loaded from the catalog snapshot when it is current
+def build_search_index():
+    snapshot = snapshot_reader.current()
+    db = SessionLocal()
+    try:
+        for structure in (movie_index, facet_counts, filter_engine):
+            if snapshot is not None:
+                structure.load(snapshot)
+            else:
+                structure.build(db)
+        autocomplete.build(db)
+        similar_movies.build(db)
+    finally:
+        db.close()
+
+@app.on_event("startup")
+def load_catalog():
+    database.check_generation(apply_catalog_changes, reload_catalog, wait=True)
+
+# background Dataverse -> SQLite sync, when SYNC_INTERVAL (seconds) is set
+sync_task = None
+background_tasks = set()
+
+@app.on_event("startup")
+async def schedule_sync():
+    global sync_task
+    if sync.SYNC_INTERVAL > 0:
+        sync_task = asyncio.create_task(sync.run_forever())
+
+# similar movies of the whole catalog, computed in the background
+@app.on_event("startup")
+async def warm_similar_movies():
+    task = asyncio.create_task(asyncio.to_thread(similar_movies.warm))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+# onscreen / offscreen / comingsoon partitions, recomputed after midnight
+@app.on_event("startup")
+async def schedule_screening_refresh():
+    task = asyncio.create_task(refresh_at_midnight())
+    background_tasks.add(task)
+
+@app.on_event("shutdown")
+async def close_dataverse_client():
+    if sync_task is not None:
+        sync_task.cancel()
+    for task in background_tasks:
+        task.cancel()
+    await dataverse.client.aclose()
+
 # health check
 @app.get("/health")
 def health():
     return "OK"
 
+# the database file was replaced by a catalog rebuild, or another process' changes are no longer
+# in the change log: rebuild everything derived from the old catalog (in a background thread,
+# database.check_generation); each structure is built aside and swapped in whole, so requests keep
+# being answered from the old catalog meanwhile
+def reload_catalog():
+    build_search_index()
+    events.catalog_reloaded()
+
+# another process changed these movies (all of them deleted first when cleared): the structures are
+# updated through the same events as for the writes of this process
+def apply_catalog_changes(cleared: bool, movie_ids: set[int]):
+    db = SessionLocal()
+    try:
+        crud.notify_changes(db, cleared, movie_ids)
+    finally:
+        db.close()
+
 # Dependency
 def get_db():
+    database.check_generation(apply_catalog_changes, reload_catalog)
     db = SessionLocal()
     try:
         yield db
@@ -39,8 +129,6 @@ def get_db():
         db.close()
 
 
-API_KEY = "9ab68902-3f25-4848-8384-3a217a763e5a"
-
 def all_movies(dataset_list: list, result: list):
     for movie in dataset_list:
         if movie['type'] =='dataverse':
@@ -51,97 +139,161 @@ def all_movies(dataset_list: list, result: list):
 # Search bar tool: search movie; access directly from Dataverse database - to update sqlite database (sync sqlite and dataverse)
 # returns a list with each movie metadata as an item in dict format
 @app.get("/movies/") 
-def read_movie(q: Union[str, None] = None):
-    result = []
-    condition = True
-    start = 0
-    rows = 10
-    while(condition):
+async def read_movie(q: Union[str, None] = None):
+    try:
         if q == None:
-            url = f"https://snu.dataverse.ac.kr/api/search?q=*&subtree=movies&start={start}&type=dataset"
+            dataset_list = await dataverse.client.search("*", subtree="movies", type="dataset")
         else:
-            url = f"https://snu.dataverse.ac.kr/api/search?q={q}&subtree=movies&start={start}"
-        headers = {
-            "X-Dataverse-key": API_KEY
-        }
-        response = requests.get(url, headers = headers)
-
-        if response.status_code == 200:
-            dataset_list = response.json()["data"]["items"]
-            result = all_movies(dataset_list, result)
-            total = response.json()["data"]["total_count"]
-            start = start + rows
-            condition = start < total
-        else:
-            return "검색 결과 없음"
-    return result
+            dataset_list = await dataverse.client.search(q, subtree="movies")
+    except dataverse.DataverseError:
+        return "검색 결과 없음"
+    return all_movies(dataset_list, [])
 
 @app.post("/movies/upload/")
 def create_movies(data: list[schemas.Movie], db: Session = Depends(get_db)):
     results = []
-    for per_movie in data:
-        db_movie = crud.get_movie_match(db, openDate=per_movie.openDate, title=per_movie.title, titleEng=per_movie.titleEng, runningTimeMinute=per_movie.runningTimeMinute)
-        if db_movie:
-            continue
-        result = crud.insert_data_into_db(db=db, data=per_movie)
-        results.append(result)
+    with database.write_lock:
+        for per_movie in data:
+            db_movie = crud.get_movie_match(db, openDate=per_movie.openDate, title=per_movie.title, titleEng=per_movie.titleEng, runningTimeMinute=per_movie.runningTimeMinute)
+            if db_movie:
+                continue
+            result = crud.insert_data_into_db(db=db, data=per_movie)
+            results.append(result)
     return results
 
-class Genre(str, Enum):
-    action = "액션"
-    drama = "드라마"
-    comedy = "코미디"
-    thriller = "스릴러"
-    fantasy = "SF/판타지"
-    romance = "로맨스"
-    adventure = "어드벤처"
-    horror = "공포"
-    crime = "범죄"
-    animation = "애니메이션"
-
-# filtering tool: filter by search query, genres, and release date range
+# bulk upload: a JSON list of movies, or NDJSON (one movie per line) streamed with
+# Content-Type: application/x-ndjson; everything is inserted in one transaction
+# returns the number of inserted and skipped (already existing) movies
+@app.post("/movies/upload/bulk")
+async def bulk_upload_movies(request: Request, db: Session = Depends(get_db)):
+    report = {"inserted": 0, "skipped": 0}
+    seen = set()
+    movie_ids = []
+    # the transaction stays open across the batches, so no rebuild may swap the file meanwhile
+    await run_in_threadpool(database.write_lock.acquire)
+    try:
+        try:
+            async for batch in movie_batches(request):
+                movie_ids += await run_in_threadpool(crud.insert_movie_batch, db, batch, seen, report)
+        except Exception:
+            await run_in_threadpool(db.rollback)
+            raise
+        await run_in_threadpool(crud.finish_bulk_insert, db, movie_ids)
+    finally:
+        database.write_lock.release()
+    return report
+
+# zero-downtime full reload: the movies of the body (like /movies/upload/bulk) replace the whole catalog;
+# they are loaded into a shadow database file that is swapped in once indexed (sql_app/rebuild.py)
+# returns the number of loaded and skipped (duplicate) movies
+@app.post("/movies/rebuild")
+async def rebuild_catalog(request: Request):
+    if not rebuild.lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Rebuild already running")
+    try:
+        async with sync.lock:
+            loader = await run_in_threadpool(rebuild.CatalogRebuild)
+            try:
+                async for batch in movie_batches(request):
+                    await run_in_threadpool(loader.add, batch)
+                report = await run_in_threadpool(loader.finish)
+            except BaseException:
+                await run_in_threadpool(loader.abort)
+                raise
+            await run_in_threadpool(database.check_generation, apply_catalog_changes, reload_catalog, True)
+        return report
+    finally:
+        rebuild.lock.release()
+
+# movies of an upload body in batches of crud.BULK_BATCH_SIZE: a JSON list, or NDJSON
+# (one movie per line) streamed with Content-Type: application/x-ndjson
+async def movie_batches(request: Request):
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        batch = []
+        buffer = b""
+        line_number = 0
+        async for chunk in request.stream():
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                line_number += 1
+                if line.strip():
+                    batch.append(parse_movie_line(line, line_number))
+            if len(batch) >= crud.BULK_BATCH_SIZE:
+                yield batch
+                batch = []
+        if buffer.strip():
+            batch.append(parse_movie_line(buffer, line_number + 1))
+        yield batch
+        return
+
+    try:
+        data = [schemas.Movie(**movie) for movie in await request.json()]
+    except (ValueError, TypeError, ValidationError) as error:
+        raise HTTPException(status_code=422, detail=str(error))
+    for start in range(0, len(data), crud.BULK_BATCH_SIZE):
+        yield data[start:start + crud.BULK_BATCH_SIZE]
+
+def parse_movie_line(line: bytes, line_number: int):
+    try:
+        return schemas.Movie(**json.loads(line))
+    except (ValueError, TypeError, ValidationError) as error:
+        raise HTTPException(status_code=422, detail=f"line {line_number}: {error}")
+
+# filtering tool: filter by search query, genres, release date range and screening status
 # returns a list with each movie metadata as an item in dict format
+# answered from the in-memory bitsets of sql_app/bitmaps.py
 @app.get("/movies/filter/")
-def filter(openyear: Union[int, None] = None, endyear: Union[int, None] = None, genres: list[Genre] = Query(None, description="List of genres to filter by"), 
-           q: Union[str, None] = None, page: int = 1, per_page: int = 15,
+def filter(request: Request, openyear: Union[int, None] = None, endyear: Union[int, None] = None, genres: list[Genre] = Query(None, description="List of genres to filter by"), 
+           q: Union[str, None] = None, page: int = 1, per_page: int = 15, cursor: Union[str, None] = None,
+           status: Union[Status, None] = None, view: View = View.full, db: Session = Depends(get_db)):
+    # a changed box office file changes the ETag (as for /movies/onscreen), so it is read first
+    if status is not None:
+        boxoffice.check()
+    # the comingsoon / offscreen selections change at midnight
+    extra = () if status is None or status == Status.onscreen else (datetime.date.today(),)
+    return etag.conditional(request, lambda: movies_response(
+        db, filter_engine.search(db, genres, openyear, endyear, page, per_page, q, cursor, status), view), *extra)
+
+# search-as-you-type: titles, actors and directors starting with q, Hangul initial consonants
+# accepted ("ㄱㅅㅊ" -> "기생충"); box office movies first, then the most recent (sql_app/autocomplete.py)
+@app.get("/movies/autocomplete")
+def autocomplete_movies(q: str, limit: int = 10, db: Session = Depends(get_db)):
+    return {"suggestions": autocomplete.lookup(q, limit, boxoffice.movie_ids(db))}
+
+# result counts per genre and per release year for a filter selection (sql_app/facets.py)
+# the counts are in memory; get_db rebuilds them when another process changed the catalog
+@app.get("/movies/facets")
+def facets(request: Request, openyear: Union[int, None] = None, endyear: Union[int, None] = None, genres: list[Genre] = Query(None, description="List of genres to filter by"),
            db: Session = Depends(get_db)):
-    movies = crud.searchquery(db, genres, openyear, endyear, page, per_page, q)
-    return movies
+    return etag.conditional(request, lambda: Response(json.dumps(facet_counts.facets(genres, openyear, endyear), ensure_ascii=False),
+                                                      media_type="application/json"))
+
+# export of the whole catalog (or the movies matching the genre / release year filters) as NDJSON,
+# streamed in constant memory; gzip=true sends a .ndjson.gz file
+@app.get("/movies/export")
+def export_movies(openyear: Union[int, None] = None, endyear: Union[int, None] = None, genres: list[Genre] = Query(None, description="List of genres to filter by"),
+                  gzip: bool = False):
+    body = export.export_movies(genres, openyear, endyear, compress=gzip)
+    if gzip:
+        return StreamingResponse(body, media_type="application/gzip",
+                                 headers={"Content-Disposition": 'attachment; filename="movies.ndjson.gz"'})
+    return StreamingResponse(body, media_type="application/x-ndjson")
 
 # Most Loved Movies in a list format
 @app.get("/movies/mostloved/")
-def mostloved(page: int = 1, per_page: int = 15, db: Session = Depends(get_db)):
-    result = []
+async def mostloved(page: int = 1, per_page: int = 15, view: View = View.full, db: Session = Depends(get_db)):
     to_return = {}
-    condition = True
-    # return_startidx = offset
-    # return_endidx = limit
     is_last = False
 
-    offset = 0
-    limit = per_page
-
     start_idx = (page-1) * per_page
     end_idx = page * per_page
 
-    # initial_start = start_idx
-    # initial_end = end_idx
-
-    while(condition):
-        url = f"https://snu.dataverse.ac.kr/api/search?q=*&subtree=mostloved&start={offset}&per_page={limit}"
-        headers = {
-            "X-Dataverse-key": API_KEY
-        }
-        response = requests.get(url, headers = headers)
-
-        if response.status_code == 200:
-            dataset_list = response.json()["data"]["items"]
-            result = all_movies(dataset_list, result)
-            total = response.json()["data"]["total_count"]
-            offset += limit
-            condition = offset < total
-        else:
-            return "검색 결과 없음"
+    try:
+        dataset_list = await dataverse.cached_search("*", subtree="mostloved")
+    except dataverse.DataverseError:
+        return "검색 결과 없음"
+    result = all_movies(dataset_list, [])
     original_data_len = len(result)
 
     if end_idx >= original_data_len:
@@ -149,247 +301,101 @@ def mostloved(page: int = 1, per_page: int = 15, db: Session = Depends(get_db)):
     to_return['isLast'] = is_last
 
     paginated_final = result[start_idx : end_idx]
-    to_return['data'] = crud.movies_with_id_data(paginated_final, db)
+    cache = cache_for(view)
+    generation = cache.generation # before the movies are loaded, see RenderCache.put
+    movies = await run_in_threadpool(crud.movies_with_id_data, paginated_final, db, view == View.full)
     to_return['totalCount'] = original_data_len
-    return to_return
+    return Response(list_body(to_return, [cache.fragment(movie, generation) for movie in movies]), media_type="application/json")
+
+# latency histograms per route and phase, in the Prometheus text format
+@app.get("/metrics")
+def read_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# hit / miss / refresh counters of the Dataverse search cache
+@app.get("/cache/stats")
+def cache_stats():
+    return dataverse.search_cache.info()
+
+# (re)build the catalog snapshot shared by the workers
+@app.post("/snapshot/")
+def rebuild_snapshot():
+    report = build_snapshot(snapshot_reader.path)
+    if report is None:
+        raise HTTPException(status_code=409, detail="Snapshot build already running")
+    return report
+
+# run one Dataverse -> SQLite sync in the background
+@app.post("/sync/")
+async def start_sync():
+    if sync.lock.locked():
+        return {"message": "Sync already running"}
+    task = asyncio.create_task(sync.run_sync())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return {"message": "Sync started"}
+
+# report (timing and row counts) of the last sync run
+@app.get("/sync/status")
+def sync_status():
+    return {"running": sync.lock.locked(), "last_report": sync.last_report}
 
 @app.post("/delete_all_records/")
 def delete_records(db: Session = Depends(get_db)):
-    crud.delete_all_records(db)
+    with database.write_lock:
+        crud.delete_all_records(db)
     return {"message": "All records deleted"}
 
-# returns Daily Box Office Movies list
-def today():
-    file_path = "./kobis 8_21.csv"
-    daily_boxoffice =  pd.read_csv(file_path, skiprows=6)
-    daily_boxoffice.reset_index(drop=True, inplace=True)
-    today_list = daily_boxoffice.iloc[:,1].tolist() 
-    today_list = pd.Series(today_list).dropna().tolist()
-    return today_list
+# page of movies (crud.paginate / crud.searchquery result) as a JSON response,
+# put together from the pre-rendered movies in render_cache (or their cards in card_cache)
+def movies_response(db: Session, result, view: View = View.full):
+    if not isinstance(result, dict):
+        return result
+    fragments = cache_for(view).get_many(db, result.pop('ids'))
+    return Response(list_body(result, fragments), media_type="application/json")
 
 # returns movies that are currently on screen 
+# list and detail endpoints answer If-None-Match with a 304 while the catalog is unchanged (sql_app/etag.py)
+# the three screening status lists are precomputed once a day / per catalog change (sql_app/screening.py)
 @app.get("/movies/onscreen")
-def onscreen(page: int = 1, per_page: int = 15, db: Session = Depends(get_db)):
-  onscreen_list = []
-  to_return = {}
-#   return_startidx = offset
-#   return_endidx = limit 
-  offset = 0
-  limit = per_page
-  is_last = False
-  start_idx = (page-1) * per_page
-  end_idx = page * per_page
-
-#   initial_start = start_idx
-#   initial_end = end_idx
-
+def onscreen(request: Request, page: int = 1, per_page: int = 15, cursor: Union[str, None] = None, view: View = View.full,
+             db: Session = Depends(get_db)):
+  boxoffice.check()
   # Box Ofice top 100 movies list
-  today_list = today()
-  query = db.query(models.Movie).filter(models.Movie.title.in_(today_list))
-  for movie in query.all():
-      movie.genre =  movie.get_list_field('genre')
-      movie.directors =  movie.get_list_field('directors')
-      movie.distributor =  movie.get_list_field('distributor')
-      movie.posterUrl =  movie.get_list_field('posterUrl')
-      movie.actors =  movie.get_list_field('actors')
-      movie.producer =  movie.get_list_field('producer')
-      movie.keywords =  movie.get_list_field('keywords')
-      movie.vodUrl =  movie.get_list_field('vodUrl')
-      movie.synopsis =  movie.get_dict_field('synopsis')
-      onscreen_list.append(movie)
-
-  # for movie in today_list:
-    # url = f"https://snu.dataverse.ac.kr/api/search?q={movie}&subtree=movies&start={offset}&per_page={limit}"
-    # headers = {
-    #     "X-Dataverse-key": API_KEY
-    # }
-    # response = requests.get(url, headers = headers)
-
-    # if response.status_code != 200:
-    #   continue 
-    # result = response.json()["data"]["items"]
-
-    # if not result:
-    #   print(f"'{movie}' 검색 결과 없음")
-    #   continue
-    # found = False
-    # for item in result:
-    #     if item['name'] == movie:
-    #         onscreen_list.append(json.loads(item['description']) )
-    #         found = True
-    #         break
-    # if not found:
-    #     print(f"'{movie}' 검색 결과 없음")
-
-  original_data_len = len(onscreen_list)
-
-  paginated_final = onscreen_list[start_idx : end_idx]
-  # to_return['data'] = crud.movies_with_id_data(paginated_final, db)
-  to_return['data'] = paginated_final
-
-  # check if it is the last page
-  if end_idx >= original_data_len:
-      is_last = True
-  to_return['isLast'] = is_last
-
-  to_return['totalCount'] = original_data_len
-  return to_return
+  return etag.conditional(request, lambda: movies_response(db, screening.page(db, "onscreen", page, per_page, cursor), view))
 
 # returns movies that are will be released in the coming two years
 @app.get("/movies/comingsoon")
-def comingsoon(page: int = 1, per_page: int = 15, db: Session = Depends(get_db)):
-  to_return = {}
-  is_last = False
-
-#   offset = 0
-#   limit = per_page
-
-  start_idx = (page-1) * per_page
-  end_idx = page * per_page
-
-#   initial_start = start_idx
-#   initial_end = end_idx
-  
-  comingsoon_list = []
-#   condition = True
-
-  query = db.query(models.Movie).filter(models.Movie.openDate != None)
-  today_date_str = datetime.date.today().strftime("%Y.%m.%d")
-  query = query.filter(models.Movie.openDate > today_date_str)
-
-  for movie in query.all():
-      movie.genre =  movie.get_list_field('genre')
-      movie.directors =  movie.get_list_field('directors')
-      movie.distributor =  movie.get_list_field('distributor')
-      movie.posterUrl =  movie.get_list_field('posterUrl')
-      movie.actors =  movie.get_list_field('actors')
-      movie.producer =  movie.get_list_field('producer')
-      movie.keywords =  movie.get_list_field('keywords')
-      movie.vodUrl =  movie.get_list_field('vodUrl')
-      movie.synopsis =  movie.get_dict_field('synopsis')
-      comingsoon_list.append(movie)
-      
-
-#   while(condition):
-#     url = f"https://snu.dataverse.ac.kr/api/search?q=*&subtree=movies&sort=name&order=asc&per_page={offset}&start={limit}"
-#     headers = {
-#             "X-Dataverse-key": API_KEY
-#         }
-#     response = requests.get(url, headers = headers)
-
-#     # compare release date with today's date 
-#     if response.status_code == 200:
-#       total = response.json()["data"]["total_count"]
-#       offset += limit
-#       condition = offset < total
-#       dataset_list = response.json()["data"]["items"]
-#       for movie in dataset_list:
-#         if movie.get("description"): 
-#           description = json.loads(movie['description']) 
-#           opendate_str = description["openDate"] 
-#           if opendate_str != '': 
-#             opendate = datetime.datetime.strptime(opendate_str, "%Y.%m.%d").date()
-#             if opendate > datetime.date.today(): 
-#               comingsoon_list.append(description)
-
-  original_data_len = len(comingsoon_list)
-  paginated_final = comingsoon_list[start_idx : end_idx]
-#   to_return['data'] = crud.movies_with_id_data(paginated_final, db)
-  to_return['data'] = paginated_final
-
-  if end_idx >= original_data_len:
-       is_last = True
-  to_return['isLast'] = is_last
-  
-  to_return['totalCount'] = original_data_len
-  return to_return
+def comingsoon(request: Request, page: int = 1, per_page: int = 15, cursor: Union[str, None] = None, view: View = View.full,
+               db: Session = Depends(get_db)):
+  return etag.conditional(request, lambda: movies_response(db, screening.page(db, "comingsoon", page, per_page, cursor), view),
+                          datetime.date.today())
     
 # returns movies that are off screen
 @app.get("/movies/offscreen")
-def offscreen(page: int = 1, per_page: int = 15, db: Session = Depends(get_db)):
-#   return_startidx = offset
-#   return_endidx = limit
-  to_return = {}
-  is_last = False
-
-  today_list = today()
-  offscreen_list = []
-#   condition = True
-
-  # offset = 0
-
-  start_idx = (page-1) * per_page
-  end_idx = page * per_page
-
-#   initial_start = start_idx
-#   initial_end = end_idx
-
-  query = db.query(models.Movie).filter(models.Movie.openDate != None)
-  # query = query.filter(func.cast(func.substring(models.Movie.openDate, 1, 4), Integer) < datetime.date.today())
-#   query = query.filter(cast(models.Movie.openDate, Date) < datetime.date.today())
-  today_date_str = datetime.date.today().strftime("%Y.%m.%d")
-  query = query.filter(models.Movie.openDate < today_date_str)
-  query = query.filter(~models.Movie.title.in_(today_list))
-
-  for movie in query.all():
-      movie.genre =  movie.get_list_field('genre')
-      movie.directors =  movie.get_list_field('directors')
-      movie.distributor =  movie.get_list_field('distributor')
-      movie.posterUrl =  movie.get_list_field('posterUrl')
-      movie.actors =  movie.get_list_field('actors')
-      movie.producer =  movie.get_list_field('producer')
-      movie.keywords =  movie.get_list_field('keywords')
-      movie.vodUrl =  movie.get_list_field('vodUrl')
-      movie.synopsis =  movie.get_dict_field('synopsis')
-      offscreen_list.append(movie)
-
-  # while(condition):
-  #   url = f"https://snu.dataverse.ac.kr/api/search?q=*&subtree=movies&sort=name&order=asc&per_page={offset}&start={per_page}"
-  #   headers = {
-  #           "X-Dataverse-key": API_KEY
-  #       }
-  #   response = requests.get(url, headers = headers)
-
-
-  #   # compare release date with today's date
-  #   if response.status_code == 200:
-  #     dataset_list = response.json()["data"]["items"]
-  #     total = response.json()["data"]["total_count"]
-  #     offset+=per_page
-  #     condition = offset < total
-  #     for movie in dataset_list:
-  #       if movie.get("description"): 
-  #         description = json.loads(movie['description']) 
-  #         opendate_str = description["openDate"] 
-  #         if opendate_str != '': 
-  #           opendate = datetime.datetime.strptime(opendate_str, "%Y.%m.%d").date()
-  #           if (opendate < datetime.date.today()) and (movie not in today_list):
-  #               offscreen_list.append(description)
-
-  original_data_len = len(offscreen_list)
-  paginated_final = offscreen_list[start_idx : end_idx]
-  if end_idx >= original_data_len:
-       is_last = True
-  to_return['isLast'] = is_last
-
-#   to_return['data'] = crud.movies_with_id_data(paginated_final, db)
-  to_return['data'] = paginated_final
-  to_return['totalCount'] = original_data_len
-  return to_return
+def offscreen(request: Request, page: int = 1, per_page: int = 15, cursor: Union[str, None] = None, view: View = View.full,
+              db: Session = Depends(get_db)):
+  boxoffice.check()
+  return etag.conditional(request, lambda: movies_response(db, screening.page(db, "offscreen", page, per_page, cursor), view),
+                          datetime.date.today())
     
 # get movies via Movie ID in database
 @app.get("/movies/detail/{id}")
-def read_movie(id: int, db: Session = Depends(get_db)):
-    movie = db.query(models.Movie).filter(models.Movie.id == id).first()
-    movie.genre =  movie.get_list_field('genre')
-    movie.directors =  movie.get_list_field('directors')
-    movie.distributor =  movie.get_list_field('distributor')
-    movie.posterUrl =  movie.get_list_field('posterUrl')
-    movie.actors =  movie.get_list_field('actors')
-    movie.producer =  movie.get_list_field('producer')
-    movie.keywords =  movie.get_list_field('keywords')
-    movie.vodUrl =  movie.get_list_field('vodUrl')
-    movie.synopsis =  movie.get_dict_field('synopsis')
-    if not movie:
-        raise HTTPException(status_code=404, detail="Movie not found")
-    return movie
+def read_movie(id: int, request: Request, db: Session = Depends(get_db)):
+    def build():
+        fragments = render_cache.get_many(db, [id])
+        if not fragments:
+            raise HTTPException(status_code=404, detail="Movie not found")
+        return Response(fragments[0], media_type="application/json")
+    return etag.conditional(request, build)
+
+# movies similar to the movie: shared genres, keywords, actors and directors (sql_app/similar.py)
+@app.get("/movies/detail/{id}/similar")
+def read_similar_movies(id: int, request: Request, limit: int = 10, db: Session = Depends(get_db)):
+    def build():
+        movie_ids = similar_movies.lookup(id, limit)
+        if movie_ids is None:
+            raise HTTPException(status_code=404, detail="Movie not found")
+        fragments = render_cache.get_many(db, movie_ids)
+        return Response(list_body({"totalCount": len(fragments)}, fragments), media_type="application/json")
+    return etag.conditional(request, build)
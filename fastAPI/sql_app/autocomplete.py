@@ -0,0 +1,342 @@
+import gc
+import heapq
+import threading
+from contextlib import contextmanager
+from typing import Union
+
+from sqlalchemy.orm import Session
+
+from . import events, models
+
+# typeahead over titles, titleEng, actors and directors
+# - a prefix trie per spelling (normalized text, and its Hangul initial consonants: "기생충" -> "ㄱㅅㅊ")
+# - every suggestion is reachable from the start of each of its words ("knight" finds "The Dark Knight")
+# - each trie node keeps its TOP_K best suggestions, so a lookup walks len(prefix) nodes
+#   whatever the size of the catalog; nodes are fixed on insert, and recomputed lazily
+#   from their subtree after a suggestion in their top list lost movies or was removed
+# - a build puts every suggestion in the tries once, then computes all the top lists bottom-up
+# - movies of the box office list are ranked first (checked against the ~100 box office movies)
+# ranking: box office presence, then the newest release date, then the number of movies
+
+TOP_K = 10
+MAX_DEPTH = 12 # longer keys end in the node at this depth, queries longer than that are filtered there
+
+CHOSUNG = "ㄱㄲㄴㄷㄸㄹㅁㅂㅃㅅㅆㅇㅈㅉㅊㅋㅌㅍㅎ"
+HANGUL_FIRST, HANGUL_LAST = 0xAC00, 0xD7A3
+
+def normalize(text: str):
+    return "".join(text.casefold().split())
+
+def chosung(text: str):
+    return "".join(CHOSUNG[(ord(char) - HANGUL_FIRST) // 588] if HANGUL_FIRST <= ord(char) <= HANGUL_LAST else char
+                   for char in text)
+
+def has_chosung(text: str):
+    return any(char in CHOSUNG for char in text)
+
+# (kind, text) of the suggestions of a movie
+def movie_entries(title, title_eng, directors, actors):
+    entries = {("title", title), ("title", title_eng)}
+    entries |= {("director", name) for name in models.decode_list(directors)}
+    entries |= {("actor", name) for name in models.decode_list(actors)}
+    return {(kind, text) for kind, text in entries if text and text.strip()}
+
+def release_ordinal(open_date):
+    parsed = models.parse_open_date(open_date)
+    return parsed.toordinal() if parsed else 0
+
+# a build allocates millions of trie nodes, none of them garbage: the cyclic collector would scan
+# the growing heap again and again (most of the build time), so it waits until the build is done
+@contextmanager
+def collector_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+# normalized keys of a text, one from the start of each word
+def word_keys(text: str):
+    words = text.split()
+    return {normalize(" ".join(words[start:])) for start in range(len(words))} - {""}
+
+class Suggestion:
+    __slots__ = ("text", "kind", "movie_ids", "score", "keys")
+
+    def __init__(self, text: str, kind: str):
+        self.text = text
+        self.kind = kind
+        self.movie_ids = {} # movie id -> release date ordinal (0 when unknown)
+        self.score = (0, 0)
+        self.keys = word_keys(text)
+
+    def rescore(self):
+        self.score = (max(self.movie_ids.values(), default=0), len(self.movie_ids))
+
+    def to_dict(self):
+        ids = sorted(self.movie_ids, key=lambda movie_id: (-self.movie_ids[movie_id], -movie_id))
+        return {"text": self.text, "type": self.kind, "ids": ids[:5]}
+
+class Node:
+    __slots__ = ("children", "top", "ends", "dirty")
+
+    def __init__(self):
+        self.children = {}
+        self.top = () # best suggestions of the subtree, best first
+        self.ends = None # suggestions with a key ending here (or longer, at MAX_DEPTH); set once one does
+        self.dirty = False
+
+class Trie:
+    def __init__(self, initials: bool = False):
+        self.root = Node()
+        self.initials = initials # keys spelled with the initial consonants
+
+    # keys without Hangul stay out of the initials trie: no query spelled with initials matches them
+    def keys(self, suggestion: Suggestion):
+        if not self.initials:
+            return suggestion.keys
+        return {initials for initials in map(chosung, suggestion.keys) if has_chosung(initials)}
+
+    def path(self, key: str, create: bool = False):
+        node = self.root
+        nodes = [node]
+        for char in key[:MAX_DEPTH]:
+            child = node.children.get(char)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[char] = Node()
+            node = child
+            nodes.append(node)
+        return nodes
+
+    def insert(self, key: str, suggestion: Suggestion):
+        nodes = self.path(key, create=True)
+        add_end(nodes[-1], suggestion)
+        for node in nodes:
+            offer(node, suggestion)
+
+    # the key's end node only; fill_tops() sets the top lists afterwards
+    def place(self, key: str, suggestion: Suggestion):
+        node = self.root
+        for char in key[:MAX_DEPTH]:
+            child = node.children.get(char)
+            if child is None:
+                child = node.children[char] = Node()
+            node = child
+        add_end(node, suggestion)
+
+    # top list of every node from its own suggestions and its children's top lists, deepest first;
+    # position: suggestion -> its place in the rank order
+    def fill_tops(self, position: dict):
+        nodes = [self.root]
+        for node in nodes: # parents before their children
+            nodes.extend(node.children.values())
+        order = position.__getitem__
+        for node in reversed(nodes):
+            children = node.children
+            if not children: # a leaf: its own suggestions
+                node.top = sorted(node.ends, key=order)[:TOP_K]
+            elif node.ends is None and len(children) == 1: # inside a chain: its child's list
+                node.top = next(iter(children.values())).top
+            else:
+                candidates = set(node.ends or ())
+                for child in children.values():
+                    candidates.update(child.top)
+                node.top = heapq.nsmallest(TOP_K, candidates, key=order)
+
+    def remove(self, key: str, suggestion: Suggestion):
+        nodes = self.path(key)
+        if nodes is None:
+            return
+        if nodes[-1].ends is not None:
+            nodes[-1].ends.discard(suggestion)
+        for node in nodes:
+            demote(node, suggestion)
+
+    # better score or new suggestion
+    def promote(self, key: str, suggestion: Suggestion):
+        for node in self.path(key, create=True):
+            offer(node, suggestion)
+
+    # worse score: the node's top list is recomputed on the next lookup
+    def demote(self, key: str, suggestion: Suggestion):
+        for node in self.path(key) or ():
+            demote(node, suggestion)
+
+    def lookup(self, key: str, limit: int):
+        nodes = self.path(key)
+        if nodes is None:
+            return []
+        node = nodes[-1]
+        if len(key) > MAX_DEPTH:
+            matches = [suggestion for suggestion in node.ends or () if any(k.startswith(key) for k in self.keys(suggestion))]
+            return sorted(matches, key=rank)[:limit]
+        if node.dirty:
+            node.top = sorted(subtree_suggestions(node), key=rank)[:TOP_K]
+            node.dirty = False
+        return list(node.top[:limit])
+
+def rank(suggestion: Suggestion):
+    return (-suggestion.score[0], -suggestion.score[1], suggestion.text)
+
+# top lists are replaced, never changed in place: a node may share its child's list (fill_tops)
+def offer(node: Node, suggestion: Suggestion):
+    if suggestion in node.top:
+        node.top = sorted(node.top, key=rank)
+    elif len(node.top) < TOP_K or rank(suggestion) < rank(node.top[-1]):
+        node.top = sorted([*node.top, suggestion], key=rank)[:TOP_K]
+
+def add_end(node: Node, suggestion: Suggestion):
+    if node.ends is None:
+        node.ends = set()
+    node.ends.add(suggestion)
+
+def demote(node: Node, suggestion: Suggestion):
+    if suggestion in node.top:
+        node.top = [other for other in node.top if other is not suggestion]
+        node.dirty = True
+
+def subtree_suggestions(node: Node):
+    found = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        found |= node.ends or set()
+        stack.extend(node.children.values())
+    return found
+
+class Autocomplete:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.text_trie = Trie()
+        self.chosung_trie = Trie(initials=True)
+        self.suggestions = {} # (kind, text) -> Suggestion
+        self.movie_suggestions = {} # movie id -> suggestions of the movie
+        self.boosted = None # (box office ids, suggestions of the box office movies)
+
+    def keys(self, suggestion: Suggestion):
+        for trie in (self.text_trie, self.chosung_trie):
+            for key in trie.keys(suggestion):
+                yield trie, key
+
+    def add(self, movie: models.Movie):
+        ordinal = release_ordinal(movie.openDate)
+        entries = movie_entries(movie.title, movie.titleEng, movie.directors, movie.actors)
+
+        # a replaced movie keeps the suggestions it still has, so unchanged tries stay clean
+        previous = {(suggestion.kind, suggestion.text): suggestion
+                    for suggestion in self.movie_suggestions.pop(movie.id, ())}
+        for entry, suggestion in previous.items():
+            if entry not in entries:
+                self.detach(movie.id, suggestion)
+        attached = []
+        for entry in entries:
+            suggestion = self.suggestions.get(entry)
+            if suggestion is None:
+                suggestion = self.suggestions[entry] = Suggestion(entry[1], entry[0])
+                suggestion.movie_ids[movie.id] = ordinal
+                suggestion.rescore()
+                for trie, key in self.keys(suggestion):
+                    trie.insert(key, suggestion)
+            else:
+                before = suggestion.score
+                suggestion.movie_ids[movie.id] = ordinal
+                suggestion.rescore()
+                for trie, key in self.keys(suggestion):
+                    if suggestion.score < before:
+                        trie.demote(key, suggestion)
+                    elif suggestion.score > before:
+                        trie.promote(key, suggestion)
+            attached.append(suggestion)
+        self.movie_suggestions[movie.id] = attached
+        self.boosted = None
+
+    def detach(self, movie_id: int, suggestion: Suggestion):
+        suggestion.movie_ids.pop(movie_id, None)
+        if suggestion.movie_ids:
+            suggestion.rescore()
+            for trie, key in self.keys(suggestion):
+                trie.demote(key, suggestion)
+        else:
+            del self.suggestions[(suggestion.kind, suggestion.text)]
+            for trie, key in self.keys(suggestion):
+                trie.remove(key, suggestion)
+
+    def remove(self, movie_id: int):
+        for suggestion in self.movie_suggestions.pop(movie_id, ()):
+            self.detach(movie_id, suggestion)
+        self.boosted = None
+
+    # catalog events, see events.py
+    def added(self, movies: list):
+        with self.lock:
+            for movie in movies:
+                self.add(movie)
+
+    def removed(self, movie_ids: list):
+        with self.lock:
+            for movie_id in movie_ids:
+                self.remove(movie_id)
+
+    def cleared(self):
+        with self.lock:
+            self.clear()
+
+    def build(self, db: Session):
+        with collector_paused():
+            fresh = Autocomplete()
+            columns = (models.Movie.id, models.Movie.openDate, models.Movie.title, models.Movie.titleEng,
+                       models.Movie.directors, models.Movie.actors)
+            for movie_id, open_date, title, title_eng, directors, actors in models.in_id_ranges(db.query(*columns), models.Movie.id):
+                ordinal = release_ordinal(open_date)
+                attached = fresh.movie_suggestions[movie_id] = []
+                for entry in movie_entries(title, title_eng, directors, actors):
+                    suggestion = fresh.suggestions.get(entry)
+                    if suggestion is None:
+                        suggestion = fresh.suggestions[entry] = Suggestion(entry[1], entry[0])
+                    suggestion.movie_ids[movie_id] = ordinal
+                    attached.append(suggestion)
+            for suggestion in fresh.suggestions.values():
+                suggestion.rescore()
+                for trie, key in fresh.keys(suggestion):
+                    trie.place(key, suggestion)
+            position = {suggestion: place for place, suggestion in enumerate(sorted(fresh.suggestions.values(), key=rank))}
+            for trie in (fresh.text_trie, fresh.chosung_trie):
+                trie.fill_tops(position)
+        events.replace_state(self, fresh)
+
+    # suggestions of the box office movies, kept until the catalog or the box office list changes
+    def boosted_suggestions(self, boxoffice_ids: frozenset):
+        if self.boosted is None or self.boosted[0] is not boxoffice_ids:
+            suggestions = {suggestion for movie_id in boxoffice_ids
+                           for suggestion in self.movie_suggestions.get(movie_id, ())}
+            self.boosted = (boxoffice_ids, sorted(suggestions, key=rank))
+        return self.boosted[1]
+
+    def lookup(self, q: str, limit: int = TOP_K, boxoffice_ids: Union[frozenset, None] = None):
+        limit = max(1, min(limit, TOP_K))
+        if has_chosung(q):
+            trie, key = self.chosung_trie, normalize(chosung(q))
+        else:
+            trie, key = self.text_trie, normalize(q)
+        if not key:
+            return []
+        with self.lock:
+            results = []
+            if boxoffice_ids:
+                results = [suggestion for suggestion in self.boosted_suggestions(boxoffice_ids)
+                           if any(k.startswith(key) for k in trie.keys(suggestion))][:limit]
+            for suggestion in trie.lookup(key, TOP_K):
+                if len(results) >= limit:
+                    break
+                if suggestion not in results:
+                    results.append(suggestion)
+            return [suggestion.to_dict() for suggestion in results]
+
+autocomplete = events.subscribe(Autocomplete())
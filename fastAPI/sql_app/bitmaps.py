@@ -0,0 +1,327 @@
+import datetime
+import threading
+from typing import Union
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from . import crud, database, events, fulltext, models
+from .boxoffice import boxoffice
+from .cache import ResultCache
+from .screening import screening
+
+# bitmap filter engine for /movies/filter/: genre, release year and screening status combined
+# - every movie gets a dense slot; one bitset (uint64 words) per genre and per release year
+#   marks the slots, plus the live slots and the slots having an openDate (crud.filter_query)
+# - a selection is the AND of the OR of its genres, the OR of its years and the status bitset,
+#   totalCount its popcount; the page is taken by rank from the slots sorted in the
+#   (open_date desc, id desc) order of crud.paginate, so no query touches SQLite
+# - inserts and deletes (events.py) set and clear bits; deleted slots are reused after compaction
+# - status bitsets (onscreen, offscreen, comingsoon, see screening.py) are computed from the
+#   release date ordinals per (date, box office version, catalog generation)
+# q is still matched by the full-text index; its matches are filtered with the same bitsets
+# the ordered result of a filter is cached (result_cache) until the catalog generation changes
+# (database.py: a write of any process), and every page of it is served from the cached list
+
+MIN_CAPACITY = 1024 # slots, a multiple of 64
+COMPACT_FRACTION = 0.5 # dead slots, as a fraction of the slots, that trigger a compaction
+MAX_ORDINAL = datetime.date.max.toordinal()
+ONE = np.uint64(1)
+
+def empty(capacity: int):
+    return np.zeros(capacity // 64, dtype=np.uint64)
+
+def grown(words, capacity: int):
+    return np.concatenate([words, empty(capacity - len(words) * 64)])
+
+def set_bit(words, slot: int):
+    words[slot >> 6] |= ONE << np.uint64(slot & 63)
+
+def clear_bit(words, slot: int):
+    words[slot >> 6] &= ~(ONE << np.uint64(slot & 63))
+
+# bool array over the slots <-> bitset words
+def unpack(words, size: int):
+    return np.unpackbits(words.view(np.uint8), count=size, bitorder="little").view(bool)
+
+def pack(flags, capacity: int):
+    packed = np.zeros(capacity // 8, dtype=np.uint8)
+    bits = np.packbits(flags, bitorder="little")
+    packed[:len(bits)] = bits
+    return packed.view(np.uint64)
+
+# one int64 per slot whose ascending order is the order of crud.paginate:
+# known dates first, newest first, then ids descending
+def sort_key(ordinal, movie_id):
+    return ((ordinal == 0).astype(np.int64) << 62) | ((MAX_ORDINAL - ordinal) << 32) | (0xFFFFFFFF - movie_id)
+
+class FilterEngine:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.capacity = MIN_CAPACITY
+        self.size = 0 # slots in use, live or dead
+        self.dead = 0
+        self.ids = np.zeros(self.capacity, dtype=np.int64)
+        self.ordinals = np.zeros(self.capacity, dtype=np.int64) # 0: unknown release date
+        self.keys = np.zeros(self.capacity, dtype=np.int64)
+        self.slot_of = {} # movie id -> slot
+        self.live = empty(self.capacity)
+        self.dated = empty(self.capacity) # openDate is not None
+        self.genres = {} # genre -> bitset
+        self.years = {} # release year -> bitset
+        self.order = None # slots sorted by key, None when stale
+        self.status = (None, None) # (screening key, {status: bitset})
+
+    def reserve(self, count: int):
+        if self.size + count <= self.capacity:
+            return
+        capacity = self.capacity
+        while self.size + count > capacity:
+            capacity *= 2
+        for name in ("ids", "ordinals", "keys"):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array, np.zeros(capacity - self.capacity, dtype=array.dtype)]))
+        self.live = grown(self.live, capacity)
+        self.dated = grown(self.dated, capacity)
+        for bitsets in (self.genres, self.years):
+            for value in bitsets:
+                bitsets[value] = grown(bitsets[value], capacity)
+        self.capacity = capacity
+
+    def bitset(self, bitsets: dict, value):
+        words = bitsets.get(value)
+        if words is None:
+            words = bitsets[value] = empty(self.capacity)
+        return words
+
+    def unset(self, slot: int):
+        for bitsets in (self.genres, self.years):
+            for words in bitsets.values():
+                clear_bit(words, slot)
+        clear_bit(self.dated, slot)
+
+    def add(self, movie_id: int, open_date: Union[str, None], genres):
+        slot = self.slot_of.get(movie_id)
+        if slot is None:
+            self.reserve(1)
+            slot = self.slot_of[movie_id] = self.size
+            self.size += 1
+            set_bit(self.live, slot)
+        else:
+            self.unset(slot)
+        parsed = models.parse_open_date(open_date) if open_date else None
+        ordinal = parsed.toordinal() if parsed else 0
+        self.ids[slot] = movie_id
+        self.ordinals[slot] = ordinal
+        self.keys[slot] = sort_key(np.int64(ordinal), np.int64(movie_id))
+        if open_date is not None:
+            set_bit(self.dated, slot)
+        if parsed:
+            set_bit(self.bitset(self.years, parsed.year), slot)
+        for genre in set(genres):
+            set_bit(self.bitset(self.genres, genre), slot)
+        self.order = None
+
+    def remove(self, movie_id: int):
+        slot = self.slot_of.pop(movie_id, None)
+        if slot is None:
+            return
+        self.unset(slot)
+        clear_bit(self.live, slot)
+        self.dead += 1
+        self.order = None
+
+    # drop the dead slots, keeping the live ones in their order
+    def compact(self):
+        slots = np.flatnonzero(unpack(self.live, self.size))
+        capacity = MIN_CAPACITY
+        while capacity < len(slots):
+            capacity *= 2
+        def moved(words):
+            return pack(unpack(words, self.size)[slots], capacity)
+        for name in ("ids", "ordinals", "keys"):
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate([array[slots], np.zeros(capacity - len(slots), dtype=array.dtype)]))
+        self.live = moved(self.live)
+        self.dated = moved(self.dated)
+        for bitsets in (self.genres, self.years):
+            for value in list(bitsets):
+                bitsets[value] = moved(bitsets[value])
+                if not bitsets[value].any():
+                    del bitsets[value]
+        self.capacity = capacity
+        self.size = len(slots)
+        self.dead = 0
+        self.slot_of = {int(movie_id): slot for slot, movie_id in enumerate(self.ids[:self.size].tolist())}
+        self.order = None
+
+    # catalog events, see events.py
+    def added(self, movies: list):
+        with self.lock:
+            self.reserve(len(movies))
+            for movie in movies:
+                self.add(movie.id, movie.openDate, movie.get_list_field("genre"))
+
+    def removed(self, movie_ids: list):
+        with self.lock:
+            for movie_id in movie_ids:
+                self.remove(movie_id)
+            if self.size > MIN_CAPACITY and self.dead > self.size * COMPACT_FRACTION:
+                self.compact()
+
+    def cleared(self):
+        with self.lock:
+            self.clear()
+
+    # rebuild the bitsets from the SQLite database (movie_genres join table and open_date column)
+    def build(self, db: Session):
+        genres = {}
+        for movie_id, genre in models.in_id_ranges(db.query(models.MovieGenre.movie_id, models.MovieGenre.genre), models.MovieGenre.movie_id):
+            genres.setdefault(movie_id, []).append(genre)
+        rows = list(models.in_id_ranges(db.query(models.Movie.id, models.Movie.openDate).order_by(models.Movie.id), models.Movie.id))
+        fresh = FilterEngine()
+        fresh.reserve(len(rows))
+        for movie_id, open_date in rows:
+            fresh.add(movie_id, open_date, genres.get(movie_id, ()))
+        events.replace_state(self, fresh)
+
+    # the same bitsets from the arrays of the catalog snapshot (snapshot.py), one array operation
+    # per bitset
+    def load(self, snapshot):
+        fresh = FilterEngine()
+        count = len(snapshot.ids)
+        fresh.reserve(count)
+        ids = snapshot.ids
+        ordinals = snapshot.ordinals.astype(np.int64)
+        fresh.size = count
+        fresh.ids[:count] = ids
+        fresh.ordinals[:count] = ordinals
+        fresh.keys[:count] = sort_key(ordinals, ids)
+        fresh.slot_of = dict(zip(ids.tolist(), range(count)))
+        fresh.live = pack(np.ones(count, dtype=bool), fresh.capacity)
+        fresh.dated = pack(snapshot.dated, fresh.capacity)
+        years = snapshot.years()
+        for year in np.unique(years[years > 0]).tolist():
+            fresh.years[year] = pack(years == year, fresh.capacity)
+        genres, offsets, indices = snapshot.string_lists("genres")
+        slots = np.repeat(np.arange(count), np.diff(offsets.astype(np.int64)))
+        for index, genre in enumerate(genres):
+            flags = np.zeros(count, dtype=bool)
+            flags[slots[indices == index]] = True
+            fresh.genres[genre] = pack(flags, fresh.capacity)
+        events.replace_state(self, fresh)
+
+    def sorted_slots(self):
+        if self.order is None:
+            self.order = np.argsort(self.keys[:self.size], kind="stable")
+        return self.order
+
+    def status_bitset(self, db: Session, status: str):
+        key = (screening.current_key(), self.size, self.capacity)
+        state_key, bitsets = self.status
+        if state_key != key:
+            today = key[0][0].toordinal()
+            onscreen_ids = boxoffice.movie_ids(db)
+            ids = self.ids[:self.size]
+            ordinals = self.ordinals[:self.size]
+            onscreen = np.isin(ids, np.fromiter(onscreen_ids, dtype=np.int64, count=len(onscreen_ids)))
+            flags = {"onscreen": onscreen,
+                     "comingsoon": ordinals > today,
+                     "offscreen": (ordinals > 0) & (ordinals < today) & ~onscreen}
+            bitsets = {name: pack(value, self.capacity) for name, value in flags.items()}
+            self.status = (key, bitsets)
+        return bitsets[status]
+
+    # bitset of the movies matching the filters, like crud.filter_query
+    def select(self, db: Session, genres, low, high, status):
+        selected = self.live & self.dated
+        if genres:
+            union = empty(self.capacity)
+            for genre in genres:
+                if genre in self.genres:
+                    union |= self.genres[genre]
+            selected &= union
+        if low is not None or high is not None:
+            union = empty(self.capacity)
+            for year, words in self.years.items():
+                if (low is None or year >= low) and (high is None or year <= high):
+                    union |= words
+            selected &= union
+        if status is not None:
+            selected &= self.status_bitset(db, status)
+        return selected
+
+    # whole ordered result of a normalized filter (see search)
+    def results(self, db: Session, genres, low, high, q, status):
+        matches = None
+        if q is not None:
+            found = fulltext.match_query(q)
+            matches = db.query(found.c.movie_id, found.c.rank).all()
+        with self.lock:
+            selected = self.select(db, genres, low, high, status)
+            if matches is None:
+                order = self.sorted_slots()
+                slots = order[unpack(selected, self.size)[order]]
+                return ResultSet(self.ids[slots], self.keys[slots])
+            # full-text matches kept by the bitset, by relevance, then in the order of crud.paginate
+            slots = np.array([self.slot_of.get(movie_id, -1) for movie_id, rank in matches], dtype=np.int64)
+            ranks = np.array([rank for movie_id, rank in matches], dtype=np.float64)
+            known = slots >= 0
+            slots, ranks = slots[known], ranks[known]
+            kept = unpack(selected, self.size)[slots]
+            slots, ranks = slots[kept], ranks[kept]
+            slots = slots[np.lexsort((self.keys[slots], ranks))]
+            return ResultSet(self.ids[slots])
+
+    # same result as crud.searchquery, plus the screening status filter
+    def search(self, db: Session, genres: list[str], openyear: Union[int, None] = None, endyear: Union[int, None] = None,
+               page: int = 1, per_page: int = 15, q: Union[str, None] = None, cursor: Union[str, None] = None,
+               status: Union[str, None] = None):
+        if status is not None:
+            boxoffice.check()
+        key = (tuple(sorted(set(genres or ()))),
+               min(openyear, 9999) if openyear is not None and openyear > 1 else None,
+               max(endyear, 0) if endyear is not None and endyear < 9999 else None,
+               q.strip() if q is not None and q.strip() else None,
+               status,
+               (datetime.date.today(), boxoffice.version) if status is not None else None)
+        after = None
+        if cursor is not None and key[3] is None:
+            open_date, movie_id = crud.parse_cursor(cursor)
+            after = int(sort_key(np.int64(open_date.toordinal() if open_date else 0), np.int64(movie_id)))
+        results = result_cache.get(key, database.known_generation, lambda: self.results(db, *key[:5]))
+        return results.page(page, per_page, after)
+
+# ordered ids of a filter result; keys (sort_key) when it is in the order of crud.paginate,
+# for the cursors
+class ResultSet:
+    def __init__(self, ids, keys=None):
+        self.ids = ids
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.ids)
+
+    def page(self, page: int = 1, per_page: int = 15, after: Union[int, None] = None):
+        if after is not None and self.keys is not None:
+            start = int(np.searchsorted(self.keys, after, side="right"))
+        else:
+            start = max(page - 1, 0) * per_page
+        end = min(start + per_page, len(self))
+        to_return = {}
+        to_return['totalCount'] = len(self)
+        to_return['isLast'] = end >= len(self)
+        to_return['ids'] = self.ids[start:end].tolist()
+        to_return['nextCursor'] = None
+        if not to_return['isLast'] and self.keys is not None:
+            key = int(self.keys[end - 1])
+            ordinal = 0 if key >> 62 else MAX_ORDINAL - (key >> 32 & 0x3FFFFFFF)
+            open_date = datetime.date.fromordinal(ordinal).strftime("%Y.%m.%d") if ordinal else ""
+            to_return['nextCursor'] = f"{open_date}|{self.ids[end - 1]}"
+        return to_return
+
+filter_engine = events.subscribe(FilterEngine())
+result_cache = ResultCache()
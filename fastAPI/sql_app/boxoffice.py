@@ -0,0 +1,90 @@
+import csv
+import hashlib
+import os
+import threading
+
+from sqlalchemy.orm import Session
+
+from . import events, metrics, models
+
+BOXOFFICE_FILE = os.environ.get("BOXOFFICE_FILE", "./kobis 8_21.csv")
+
+# KOBIS daily box office export: 6 lines of report header, the column header, then one movie per row
+HEADER_LINES = 6
+TITLE_COLUMN = 1
+
+def read_titles(content: bytes):
+    rows = list(csv.reader(content.decode("utf-8-sig").splitlines()))
+    return [row[TITLE_COLUMN] for row in rows[HEADER_LINES + 1:]
+            if len(row) > TITLE_COLUMN and row[TITLE_COLUMN]]
+
+# Daily Box Office Movies list, parsed once and reloaded only when the file changes
+# (mtime first, then content hash); titles are resolved to movie ids once per load
+# generation counts the changes (catalog events, new list), so ids resolved while one was applied
+# are not kept
+class BoxOffice:
+    def __init__(self, path: str = BOXOFFICE_FILE):
+        self.path = path
+        self.mtime = None
+        self.digest = None
+        self.titles = []
+        self.ids = None
+        self.version = 0 # bumped every time the list changes
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def check(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            with metrics.span("boxoffice_csv"):
+                with open(self.path, "rb") as f:
+                    content = f.read()
+                digest = hashlib.sha1(content).hexdigest()
+                if digest != self.digest:
+                    self.titles = read_titles(content)
+                    self.digest = digest
+                    self.ids = None
+                    self.generation += 1
+                    self.version += 1
+                    events.boxoffice_reloaded()
+            self.mtime = mtime
+
+    # ids of the box office movies, looked up through the title index
+    def movie_ids(self, db: Session):
+        self.check()
+        ids = self.ids
+        if ids is None:
+            generation = self.generation
+            ids = set()
+            titles = list(dict.fromkeys(self.titles))
+            if titles:
+                ids = {row.id for row in db.query(models.Movie.id).filter(models.Movie.title.in_(titles))}
+            ids = frozenset(ids)
+            with self.lock:
+                if generation == self.generation:
+                    self.ids = ids
+        return ids
+
+    def invalidate(self):
+        with self.lock:
+            self.ids = None
+            self.generation += 1
+
+    # catalog events, see events.py: ids are resolved again on the next request
+    def added(self, movies: list):
+        self.invalidate()
+
+    def removed(self, movie_ids: list):
+        self.invalidate()
+
+    def cleared(self):
+        self.invalidate()
+
+    def reloaded(self):
+        self.invalidate()
+
+boxoffice = events.subscribe(BoxOffice())
@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Union
+
+# size-bounded LRU cache with a TTL for results of async fetches
+# - expired entries are served stale while one background refresh runs
+# - concurrent misses of the same key share a single fetch
+class SearchCache:
+    def __init__(self, maxsize: int = 256, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (time stored, value)
+        self.inflight = {} # key -> task fetching the key
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "coalesced": 0,
+                      "refreshes": 0, "refresh_errors": 0, "evictions": 0}
+
+    async def get(self, key, fetch):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            stored_at, value = entry
+            if time.monotonic() - stored_at < self.ttl:
+                self.stats["hits"] += 1
+            else:
+                self.stats["stale"] += 1
+                if key not in self.inflight:
+                    self.stats["refreshes"] += 1
+                    self.start(key, fetch).add_done_callback(self.refresh_done)
+            return value
+
+        self.stats["misses"] += 1
+        task = self.inflight.get(key)
+        if task is None:
+            task = self.start(key, fetch)
+        else:
+            self.stats["coalesced"] += 1
+        # a cancelled caller must not cancel the fetch other callers are waiting for
+        return await asyncio.shield(task)
+
+    def start(self, key, fetch):
+        task = asyncio.ensure_future(self.run(key, fetch))
+        self.inflight[key] = task
+        return task
+
+    async def run(self, key, fetch):
+        try:
+            value = await fetch()
+            self.put(key, value)
+            return value
+        finally:
+            self.inflight.pop(key, None)
+
+    def refresh_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.stats["refresh_errors"] += 1
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def info(self):
+        return dict(self.stats, size=len(self.entries), maxsize=self.maxsize, ttl=self.ttl)
+
+# LRU cache of computed result sets (sequences), invalidated as a whole by a generation number
+# that grows with every change of the data they come from (database.known_generation)
+# - an entry is only served for the generation it was computed under, so it is never stale
+# - nothing is cached while the generation is unknown (None)
+# - bounded by the total length of the cached results
+class ResultCache:
+    def __init__(self, maxsize: int = 2_000_000):
+        self.maxsize = maxsize
+        self.generation = -1
+        self.entries = OrderedDict() # key -> result
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def get(self, key, generation: Union[int, None], compute):
+        if generation is None:
+            return compute()
+        with self.lock:
+            if generation > self.generation:
+                if self.entries:
+                    self.stats["invalidations"] += 1
+                self.clear()
+                self.generation = generation
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return value
+            self.stats["misses"] += 1
+        value = compute()
+        with self.lock:
+            # computed under an older generation (a change was committed meanwhile): not kept
+            if generation == self.generation and key not in self.entries:
+                self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        if len(value) > self.maxsize:
+            return
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.maxsize:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def info(self):
+        return dict(self.stats, entries=len(self.entries), size=self.size, maxsize=self.maxsize,
+                    generation=self.generation)
@@ -1,29 +1,183 @@
 from sqlalchemy.orm import Session
+from fastapi import HTTPException
 
-from . import models, schemas
-from sqlalchemy import and_, or_, func, cast, Integer
+from . import database, events, fulltext, models, schemas
+from .search_index import movie_index
+from sqlalchemy import and_, or_, func, insert, select, tuple_
 from typing import Union
-import json, requests
+import datetime
 
-API_KEY = "9ab68902-3f25-4848-8384-3a217a763e5a"
+BULK_BATCH_SIZE = 500
+
+def fingerprint_columns():
+    return [getattr(models.Movie, column) for column in models.FINGERPRINT]
+
+def fingerprint(data: schemas.Movie):
+    return tuple(getattr(data, column) for column in models.FINGERPRINT)
+
+# fingerprint -> id of the movies having one of the fingerprints
+def movie_ids_by_fingerprint(db: Session, keys):
+    keys = set(keys)
+    if not keys:
+        return {}
+    rows = db.query(*fingerprint_columns(), models.Movie.id).filter(tuple_(*fingerprint_columns()).in_(keys))
+    return {tuple(row[:-1]): row[-1] for row in rows}
 
 # check if there are duplicate movies
 def get_movie_match(db: Session, openDate: str, title: str, runningTimeMinute: str, titleEng: str):
-    name = db.query(models.Movie).filter(models.Movie.title == title).first()
-    nameEng = db.query(models.Movie).filter(models.Movie.titleEng == titleEng).first()
-    runningtime = db.query(models.Movie).filter(models.Movie.runningTimeMinute == runningTimeMinute).first()
-    openDate = db.query(models.Movie).filter(models.Movie.openDate == openDate).first()
+    match = db.query(models.Movie.id).filter(models.Movie.title == title,
+                                             models.Movie.titleEng == titleEng,
+                                             models.Movie.openDate == openDate,
+                                             models.Movie.runningTimeMinute == runningTimeMinute).first()
     result = 0
-    if nameEng is not None and name is not None and runningtime is not None and openDate is not None:
+    if match is not None:
         result = 1
     return result
 
+# column values of a movie row, with the list / dict fields encoded as JSON
+def movie_row(data: schemas.Movie):
+    row = {"title": data.title,
+           "titleEng": data.titleEng,
+           "openDate": data.openDate,
+           "runningTimeMinute": data.runningTimeMinute,
+           "plot_hash": models.plot_hash(data.synopsis),
+           **models.open_date_columns(data.openDate)}
+    for field in ("genre", "actors", "directors", "producer", "distributor", "keywords", "posterUrl", "vodUrl", "synopsis"):
+        row[field] = getattr(data, field)
+    return row
+
+def link_fields(data: schemas.Movie):
+    return {"genre": data.genre, "directors": data.directors, "actors": data.actors,
+            "producer": data.producer, "keywords": data.keywords}
+
+def fts_row(movie_id: int, data: schemas.Movie):
+    fields = link_fields(data)
+    fields.update(title=data.title, titleEng=data.titleEng, synopsis=data.synopsis)
+    return fulltext.fts_row(movie_id, fields)
+
+# bulk upload, step 1: insert one batch inside the caller's transaction
+# movies already in the database (one fingerprint query per batch) or earlier in the upload are skipped
+# seen: fingerprints of the upload so far; report: {"inserted": n, "skipped": n}, updated in place
+def insert_movie_batch(db: Session, batch: list[schemas.Movie], seen: set, report: dict):
+    keys = [fingerprint(data) for data in batch]
+    existing = set()
+    if keys:
+        existing = {tuple(row) for row in db.execute(select(*fingerprint_columns())
+                                                     .where(tuple_(*fingerprint_columns()).in_(set(keys))))}
+    new_movies = {}
+    for key, data in zip(keys, batch):
+        if key in existing or key in seen:
+            report["skipped"] += 1
+            continue
+        seen.add(key)
+        new_movies[key] = data
+    if not new_movies:
+        return []
+
+    db.execute(insert(models.Movie), [movie_row(data) for data in new_movies.values()])
+    ids = db.execute(select(models.Movie.id, *fingerprint_columns())
+                     .where(tuple_(*fingerprint_columns()).in_(list(new_movies)))).all()
+    link_tables = (models.MovieGenre, models.MoviePerson, models.MovieKeyword)
+    link_batches = ([], [], [])
+    fts_rows = []
+    for row in ids:
+        data = new_movies[tuple(row[1:])]
+        for rows, new_rows in zip(link_batches, models.link_rows(row.id, link_fields(data))):
+            rows.extend(new_rows)
+        fts_rows.append(fts_row(row.id, data))
+    for table, rows in zip(link_tables, link_batches):
+        if rows:
+            db.execute(insert(table), rows)
+    fulltext.insert_rows(db, fts_rows)
+    report["inserted"] += len(ids)
+    return [row.id for row in ids]
+
+# bulk upload, step 2: commit the whole upload and update the in-memory structures
+def finish_bulk_insert(db: Session, movie_ids: list[int]):
+    commit_changes(db, movie_ids, [])
+
+# commit and notify the in-memory structures of added / replaced and removed movies
+def commit_changes(db: Session, added_ids: list[int], removed_ids: list[int]):
+    if not added_ids and not removed_ids:
+        db.commit()
+        return
+    with database.generation_lock:
+        generation = database.bump_generation(db, [*added_ids, *removed_ids])
+        db.commit()
+        if removed_ids:
+            events.movies_removed(removed_ids)
+        notify_added(db, added_ids)
+        database.applied_generation(generation)
+
+def notify_added(db: Session, movie_ids: list[int]):
+    for start in range(0, len(movie_ids), BULK_BATCH_SIZE):
+        chunk = movie_ids[start:start + BULK_BATCH_SIZE]
+        events.movies_added(models.with_details(db.query(models.Movie)).filter(models.Movie.id.in_(chunk)).all())
+
+# changes another process committed (database.check_generation): the same events as for the writes
+# of this process, from the rows as they are now (a movie deleted since is removed)
+def notify_changes(db: Session, cleared: bool, movie_ids: set[int]):
+    if cleared:
+        events.catalog_cleared()
+    movie_ids = sorted(movie_ids)
+    present = []
+    for start in range(0, len(movie_ids), BULK_BATCH_SIZE):
+        chunk = movie_ids[start:start + BULK_BATCH_SIZE]
+        present.extend(movie_id for (movie_id,) in db.query(models.Movie.id).filter(models.Movie.id.in_(chunk)))
+    removed_ids = sorted(set(movie_ids) - set(present))
+    if removed_ids:
+        events.movies_removed(removed_ids)
+    notify_added(db, present)
+
+def delete_links(db: Session, movie_ids: list[int]):
+    for table in (models.MovieGenre, models.MoviePerson, models.MovieKeyword):
+        db.query(table).filter(table.movie_id.in_(movie_ids)).delete(synchronize_session=False)
+    fulltext.delete_rows(db, movie_ids)
+
+# overwrite an existing movie with new data, keeping its id (not committed);
+# a movie whose row is missing is inserted again with that id
+def replace_movie(db: Session, movie_id: int, data: schemas.Movie):
+    updated = db.query(models.Movie).filter(models.Movie.id == movie_id).update(movie_row(data), synchronize_session=False)
+    if not updated:
+        db.execute(insert(models.Movie), [dict(movie_row(data), id=movie_id)])
+    delete_links(db, [movie_id])
+    insert_links(db, movie_id, link_fields(data))
+    fulltext.insert_rows(db, [fts_row(movie_id, data)])
+
+# delete movies by id (not committed)
+def delete_movies(db: Session, movie_ids: list[int]):
+    if not movie_ids:
+        return
+    delete_links(db, movie_ids)
+    db.query(models.Movie).filter(models.Movie.id.in_(movie_ids)).delete(synchronize_session=False)
+
+# insert many movies in one transaction, in executemany batches
+def bulk_insert_movies(db: Session, movies, batch_size: int = BULK_BATCH_SIZE):
+    report = {"inserted": 0, "skipped": 0}
+    seen = set()
+    movie_ids = []
+    batch = []
+    try:
+        for data in movies:
+            batch.append(data)
+            if len(batch) >= batch_size:
+                movie_ids += insert_movie_batch(db, batch, seen, report)
+                batch = []
+        movie_ids += insert_movie_batch(db, batch, seen, report)
+    except Exception:
+        db.rollback()
+        raise
+    finish_bulk_insert(db, movie_ids)
+    return report
+
 # insert movie metadata into SQLite database
 def insert_data_into_db(db: Session, data: schemas.Movie):
     db_movie = models.Movie(title = data.title,
                             titleEng = data.titleEng,
                             openDate = data.openDate,
-                            runningTimeMinute = data.runningTimeMinute)
+                            runningTimeMinute = data.runningTimeMinute,
+                            plot_hash = models.plot_hash(data.synopsis),
+                            **models.open_date_columns(data.openDate))
     db_movie.set_list_field("genre", data.genre)
     db_movie.set_list_field("actors", data.actors)
     db_movie.set_list_field("directors", data.directors)
@@ -35,181 +189,183 @@ def insert_data_into_db(db: Session, data: schemas.Movie):
     db_movie.set_dict_field("synopsis", data.synopsis)
 
     db.add(db_movie)
-    db.commit()
-    db.refresh(db_movie)
+    db.flush()
+    insert_links(db, db_movie.id, link_fields(data))
+    fulltext.insert_rows(db, [fts_row(db_movie.id, data)])
+    with database.generation_lock:
+        generation = database.bump_generation(db, [db_movie.id])
+        db.commit()
+        db.refresh(db_movie)
+        events.movies_added([db_movie])
+        database.applied_generation(generation)
     return db_movie
 
+# fill movie_genre / movie_person / movie_keyword for one movie
+def insert_links(db: Session, movie_id: int, fields: dict):
+    link_tables = (models.MovieGenre, models.MoviePerson, models.MovieKeyword)
+    for table, rows in zip(link_tables, models.link_rows(movie_id, fields)):
+        if rows:
+            db.execute(insert(table), rows)
+
+# (title, plot hash) of a Dataverse movie description
+def match_key(movie: dict):
+    return (movie['title'], models.plot_hash(movie.get('synopsis')))
+
+# rows grouped by (title, plot_hash), loaded with one indexed query; plot_hash is selected as a
+# column of its own, as reading the deferred attribute would load it with one query per row
+def movies_by_key(query, keys):
+    by_key = {}
+    if keys:
+        rows = query.add_columns(models.Movie.plot_hash).filter(tuple_(models.Movie.title, models.Movie.plot_hash).in_(set(keys)))
+        for movie, plot_hash in rows:
+            by_key.setdefault((movie.title, plot_hash), []).append(movie)
+    return by_key
+
 # find matching movies by comparing data between Dataverse and SQLite database 
-def movies_with_id_data(dataset_list: list, db: Session):
+# details=False leaves the deferred detail columns unloaded (list cards)
+def movies_with_id_data(dataset_list: list, db: Session, details: bool = True):
     data_with_id = []
-    sql_moviedata = db.query(models.Movie).all()
-    for movie in dataset_list: # Dataverse
-        for filtered_movie in sql_moviedata:
-            if movie['title'] == filtered_movie.title and movie['synopsis']['plotText'] == json.loads(filtered_movie.synopsis)['plotText']:
-                # final.append(json.loads(movie["description"]))
-                filtered_movie.genre =  filtered_movie.get_list_field('genre')
-                filtered_movie.directors =  filtered_movie.get_list_field('directors')
-                filtered_movie.distributor =  filtered_movie.get_list_field('distributor')
-                filtered_movie.posterUrl =  filtered_movie.get_list_field('posterUrl')
-                filtered_movie.actors =  filtered_movie.get_list_field('actors')
-                filtered_movie.producer =  filtered_movie.get_list_field('producer')
-                filtered_movie.keywords =  filtered_movie.get_list_field('keywords')
-                filtered_movie.vodUrl =  filtered_movie.get_list_field('vodUrl')
-                filtered_movie.synopsis =  filtered_movie.get_dict_field('synopsis')
-                data_with_id.append(filtered_movie)
+    keys = [match_key(movie) for movie in dataset_list]
+    query = db.query(models.Movie)
+    sql_moviedata = movies_by_key(models.with_details(query) if details else query, keys)
+    for key in keys: # Dataverse
+        for filtered_movie in sql_moviedata.get(key, []):
+            data_with_id.append(filtered_movie)
     return data_with_id
 
-# search movie : accessing from the SQLite database. 
+# search movie : accessing from the SQLite database through the in-memory inverted index
+# matches directors, actors, keywords, title and titleEng; each movie is returned once
 def search_movies(db: Session, search_query: Union[str, None] = None):
-    query = db.query(models.Movie)
+    query = models.with_details(db.query(models.Movie))
     if search_query is not None:
-        matching_movies = []
-        for movie in query.all():
-            movie_directors = json.loads(movie.directors)
-            movie_actors = json.loads(movie.actors)
-            movie_keywords = json.loads(movie.keywords)
-            if search_query in movie_directors:
-                matching_movies.append(movie)
-            if search_query in movie_actors:
-                matching_movies.append(movie)
-            if search_query in movie_keywords:
-                matching_movies.append(movie)
-            if movie.title == search_query:
-                matching_movies.append(movie)
-        return matching_movies
+        movie_ids = movie_index.lookup(search_query)
+        if not movie_ids:
+            return []
+        return query.filter(models.Movie.id.in_(movie_ids)).order_by(models.Movie.id).all()
 
     return query.all()
 
+# release years -> range scan on the indexed open_date column
+def filter_years(query, openyear: Union[int, None] = None, endyear: Union[int, None] = None):
+    if openyear is not None and openyear > 1:
+        query = query.filter(models.Movie.open_date >= datetime.date(min(openyear, 9999), 1, 1))
+    if endyear is not None and endyear < 9999:
+        query = query.filter(models.Movie.open_date < datetime.date(max(endyear, 0) + 1, 1, 1))
+    return query
+
 # filtering tool: filter by the range of year released (openDate)
 def get_opendate(db: Session, openyear: Union[int, None]=0, endyear: Union[int, None]=9999):
-    query = db.query(models.Movie).filter(models.Movie.openDate != None)
-
-    if openyear is not None:
-        query = query.filter(func.cast(func.substring(models.Movie.openDate, 1, 4), Integer) >= openyear)
-    if endyear is not None:
-        query = query.filter(func.cast(func.substring(models.Movie.openDate, 1, 4), Integer) <= endyear)
+    query = models.with_details(db.query(models.Movie)).filter(models.Movie.open_date != None)
+    return filter_years(query, openyear, endyear).all()
 
-    return query.all()
+# ids of the movies having any (union) or all (match_all, intersection) of the genres
+def genre_movie_ids(genres: list[str], match_all: bool = False):
+    genres = list(dict.fromkeys(genres))
+    ids = select(models.MovieGenre.movie_id).where(models.MovieGenre.genre.in_(genres))
+    if match_all:
+        ids = ids.group_by(models.MovieGenre.movie_id).having(
+            func.count(models.MovieGenre.genre) == len(genres))
+    return ids
 
-# filtering tool: filter by genres (union method)
-def get_genre(db: Session, genres: list[str]):
-    query = db.query(models.Movie).filter(models.Movie.genre != None)
+# filtering tool: filter by genres (union method, or intersection with match_all)
+def get_genre(db: Session, genres: list[str], match_all: bool = False):
+    query = models.with_details(db.query(models.Movie)).filter(models.Movie.genre != None)
 
     if genres is not None and genres:
-        matching_movies = []
-        for movie in query.all():
-            movie_genres = json.loads(movie.genre)
-            if any(genre in movie_genres for genre in genres):
-                matching_movies.append(movie)
-        return matching_movies
+        query = query.filter(models.Movie.id.in_(genre_movie_ids(genres, match_all)))
 
     return query.all()
 
-# find matching movies by comparing data between Dataverse and SQLite database 
-def all_movies_dataset(dataset_list: list, result: list, final:list):
-    for movie in dataset_list:
-        for filtered_movie in result:
-            if movie['name'] == filtered_movie.title and json.loads(movie["description"])['synopsis']['plotText'] == (filtered_movie.synopsis)['plotText']:
-                # final.append(json.loads(movie["description"]))
-                final.append(filtered_movie)
-    return final
+# movies a person took part in, optionally only in one role (director / actor / producer)
+def get_person_movies(db: Session, name: str, role: Union[str, None] = None):
+    ids = select(models.MoviePerson.movie_id).where(models.MoviePerson.name == name)
+    if role is not None:
+        ids = ids.where(models.MoviePerson.role == role)
+    return models.with_details(db.query(models.Movie)).filter(models.Movie.id.in_(ids)).all()
 
-# returns filtered movies based on the user's query / filter options
-def searchquery(db: Session, genres: list[str], openyear: Union[int, None]=0, endyear: Union[int, None]=9999, page: int = 1, per_page: int = 15, q: Union[str,None]=None):
-    result = filtering(db, genres, openyear, endyear)
-    final = []
+# cursor of the last movie of a page: "YYYY.MM.DD|id" in the (open_date desc, id desc) order
+# movies without a release date come last and have an empty date in the cursor
+def make_cursor(movie):
+    open_date = movie.open_date.strftime("%Y.%m.%d") if movie.open_date else ""
+    return f"{open_date}|{movie.id}"
+
+def parse_cursor(cursor: str):
+    open_date, _, movie_id = cursor.rpartition("|")
+    try:
+        return (models.parse_open_date(open_date) if open_date else None), int(movie_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def after_cursor(query, cursor: str):
+    open_date, movie_id = parse_cursor(cursor)
+    if open_date is None:
+        return query.filter(models.Movie.open_date == None, models.Movie.id < movie_id)
+    return query.filter(or_(models.Movie.open_date < open_date,
+                            and_(models.Movie.open_date == open_date, models.Movie.id < movie_id),
+                            models.Movie.open_date == None))
+
+# pagination done by the database: COUNT(*) for totalCount and LIMIT/OFFSET (or keyset cursor) for the page
+# one extra row is fetched to know whether this is the last page
+# only the ids of the page are returned ('ids'); the movies are rendered by render_cache
+def paginate(query, page: int = 1, per_page: int = 15, cursor: Union[str, None] = None):
     to_return = {}
-    # return_startidx = offset
-    # return_endidx = limit
-    is_last = False
-    condition = True
-
-    offset = 0
-    limit = per_page
-
-    start_idx = (page-1) * per_page
-    end_idx = page * per_page
-
-    initial_start = start_idx
-    initial_end = end_idx
-
-    if q is not None:
-        while(condition):
-            url = f"https://snu.dataverse.ac.kr/api/search?q={q}&subtree=movies&start={offset}&per_page={per_page}"
-            headers = {
-                "X-Dataverse-key": API_KEY
-            }
-            response = requests.get(url, headers = headers)
-
-            if response.status_code == 200:
-                dataset_list = response.json()["data"]["items"]
-                final = all_movies_dataset(dataset_list, result, final)
-
-                total = response.json()["data"]["total_count"]
-                offset += limit
-                condition = offset < total
-
-            else:
-                return "검색 결과 없음"
+    to_return['totalCount'] = query.with_entities(func.count(models.Movie.id)).order_by(None).scalar()
+
+    query = query.order_by(models.Movie.open_date.desc(), models.Movie.id.desc())
+    if cursor is not None:
+        query = after_cursor(query, cursor)
     else:
-        final = result
-
-    original_data_len = len(final)
-
-    if initial_end >= original_data_len:
-       is_last = True
-    to_return['isLast'] = is_last
-            
-    # Apply offset and limit to the final result
-    paginated_final = final[initial_start : initial_end]
-    to_return['data'] = paginated_final
-    to_return['totalCount'] = original_data_len
+        query = query.offset(max(page - 1, 0) * per_page)
+    movies = query.with_entities(models.Movie.id, models.Movie.open_date).limit(per_page + 1).all()
+
+    to_return['isLast'] = len(movies) <= per_page
+    to_return['ids'] = [movie.id for movie in movies[:per_page]]
+    to_return['nextCursor'] = None if to_return['isLast'] else make_cursor(movies[per_page - 1])
     return to_return
 
-# filtering tool: filter movies by range of year released and genres
-def filtering(db: Session, genres: list[str], openyear: Union[int, None]=0, endyear: Union[int, None]=9999, q: Union[str,None]=None):
-    query = db.query(models.Movie).filter(models.Movie.openDate != None)
+# returns filtered movies based on the user's query / filter options
+# q is searched locally (full-text index) and the matches are ranked by relevance
+def searchquery(db: Session, genres: list[str], openyear: Union[int, None]=0, endyear: Union[int, None]=9999, page: int = 1, per_page: int = 15, q: Union[str,None]=None, cursor: Union[str, None] = None):
+    query = filter_query(db, genres, openyear, endyear)
+    if q is None or not q.strip():
+        return paginate(query, page, per_page, cursor)
+
+    to_return = {}
+    matches = fulltext.match_query(q)
+    query = query.join(matches, models.Movie.id == matches.c.movie_id)
+    to_return['totalCount'] = query.with_entities(func.count(models.Movie.id)).order_by(None).scalar()
 
-    if openyear is not None:
-        query = query.filter(func.cast(func.substring(models.Movie.openDate, 1, 4), Integer) >= openyear)
-    if endyear is not None:
-        query = query.filter(func.cast(func.substring(models.Movie.openDate, 1, 4), Integer) <= endyear)
+    rows = (query.with_entities(models.Movie.id)
+            .order_by(matches.c.rank, models.Movie.open_date.desc(), models.Movie.id.desc())
+            .offset(max(page - 1, 0) * per_page).limit(per_page + 1).all())
+    to_return['isLast'] = len(rows) <= per_page
+    to_return['ids'] = [row.id for row in rows[:per_page]]
+    to_return['nextCursor'] = None
+    return to_return
+
+# filter movies by range of year released and genres, as a query that is not executed yet
+def filter_query(db: Session, genres: list[str], openyear: Union[int, None]=0, endyear: Union[int, None]=9999):
+    query = filter_years(db.query(models.Movie).filter(models.Movie.openDate != None), openyear, endyear)
     if genres is not None and genres:
-        matching_movies = []
-        for movie in query.all():
-            # movie_genres = json.loads(movie.genre)
-            movie_genres = movie.get_list_field('genre')
-            if any(genre in movie_genres for genre in genres):
-                movie.genre =  movie.get_list_field('genre')
-                movie.directors =  movie.get_list_field('directors')
-                movie.distributor =  movie.get_list_field('distributor')
-                movie.posterUrl =  movie.get_list_field('posterUrl')
-                movie.actors =  movie.get_list_field('actors')
-                movie.producer =  movie.get_list_field('producer')
-                movie.keywords =  movie.get_list_field('keywords')
-                movie.vodUrl =  movie.get_list_field('vodUrl')
-                movie.synopsis =  movie.get_dict_field('synopsis')
-                matching_movies.append(movie)
-
-        # Sort the matching movies by openDate in descending order
-        matching_movies.sort(key=lambda movie: movie.openDate, reverse=True)
-            
-        return matching_movies
-    
-    matching_movies = query.order_by(models.Movie.openDate.desc()).all()
-    for movie in matching_movies:
-        movie.genre =  movie.get_list_field('genre')
-        movie.directors =  movie.get_list_field('directors')
-        movie.distributor =  movie.get_list_field('distributor')
-        movie.posterUrl =  movie.get_list_field('posterUrl')
-        movie.actors =  movie.get_list_field('actors')
-        movie.producer =  movie.get_list_field('producer')
-        movie.keywords =  movie.get_list_field('keywords')
-        movie.vodUrl =  movie.get_list_field('vodUrl')
-        movie.synopsis =  movie.get_dict_field('synopsis')
-    return matching_movies
+        query = query.filter(models.Movie.id.in_(genre_movie_ids(genres)))
+    return query
+
+# filtering tool: filter movies by range of year released and genres
+def filtering(db: Session, genres: list[str], openyear: Union[int, None]=0, endyear: Union[int, None]=9999, q: Union[str,None]=None):
+    query = filter_query(db, genres, openyear, endyear)
+    return models.with_details(query).order_by(models.Movie.open_date.desc(), models.Movie.id.desc()).all()
 
 # Delete all from the databse
 def delete_all_records(db: Session):
+    db.query(models.MovieGenre).delete()
+    db.query(models.MoviePerson).delete()
+    db.query(models.MovieKeyword).delete()
+    fulltext.delete_all(db)
     db.query(models.Movie).delete()
-    db.commit()
+    db.query(models.SyncState).delete()
+    db.query(models.SyncCheckpoint).delete()
+    with database.generation_lock:
+        generation = database.bump_generation(db, cleared=True)
+        db.commit()
+        events.catalog_cleared()
+        database.applied_generation(generation)
@@ -0,0 +1,95 @@
+import asyncio
+import os
+from typing import Union
+
+import httpx
+
+from . import metrics
+from .cache import SearchCache
+
+# shared async client for the Dataverse search API (/api/search)
+# DATAVERSE_URL can point to a local stub server speaking the same format
+DATAVERSE_URL = os.environ.get("DATAVERSE_URL", "https://snu.dataverse.ac.kr")
+API_KEY = os.environ.get("DATAVERSE_KEY", "9ab68902-3f25-4848-8384-3a217a763e5a")
+CACHE_TTL = float(os.environ.get("DATAVERSE_CACHE_TTL", "300"))
+CACHE_SIZE = int(os.environ.get("DATAVERSE_CACHE_SIZE", "256"))
+
+class DataverseError(Exception):
+    pass
+
+class DataverseClient:
+    def __init__(self, base_url: str = DATAVERSE_URL, api_key: str = API_KEY, per_page: int = 100,
+                 concurrency: int = 4, timeout: float = 10.0, retries: int = 3, transport=None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.per_page = per_page
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.transport = transport
+        self.client = None
+
+    # one keep-alive connection pool, created on first use
+    def http(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"X-Dataverse-key": self.api_key},
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.concurrency,
+                                    max_keepalive_connections=self.concurrency),
+                transport=self.transport,
+            )
+        return self.client
+
+    # one page of search results: the "data" object of the response
+    async def fetch_page(self, params: dict, start: int, per_page: int):
+        params = dict(params, start=start, per_page=per_page)
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.span("dataverse"):
+                    response = await self.http().get("/api/search", params=params)
+            except httpx.TransportError as error:
+                if attempt == self.retries:
+                    raise DataverseError(str(error))
+            else:
+                if response.status_code == 200:
+                    return response.json()["data"]
+                # client errors will not get better by retrying
+                if response.status_code < 500 or attempt == self.retries:
+                    raise DataverseError(f"Dataverse search failed: {response.status_code}")
+            await asyncio.sleep(0.2 * 2 ** attempt)
+
+    # all items of a search: the first page gives total_count, the other pages are fetched concurrently
+    async def search(self, q: str = "*", subtree: str = "movies", type: Union[str, None] = None,
+                     per_page: Union[int, None] = None):
+        per_page = per_page or self.per_page
+        params = {"q": q, "subtree": subtree}
+        if type is not None:
+            params["type"] = type
+
+        first = await self.fetch_page(params, 0, per_page)
+        items = list(first["items"])
+        total = first["total_count"]
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        async def fetch(start):
+            async with semaphore:
+                return await self.fetch_page(params, start, per_page)
+
+        pages = await asyncio.gather(*(fetch(start) for start in range(per_page, total, per_page)))
+        for page in pages:
+            items.extend(page["items"])
+        return items
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+client = DataverseClient()
+search_cache = SearchCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+
+# search results cached by (subtree, q, type); see SearchCache for stale / coalescing behaviour
+async def cached_search(q: str = "*", subtree: str = "movies", type: Union[str, None] = None):
+    return await search_cache.get((subtree, q, type), lambda: client.search(q, subtree, type))
@@ -0,0 +1,70 @@
+import hashlib
+import threading
+import uuid
+
+from fastapi import Request, Response
+
+from . import database, events
+
+# conditional GET for the read-only endpoints
+# the ETag is derived from the process boot id, the catalog version, the catalog generation shared by
+# the processes (database.py) and the request URL (plus e.g. today's date for endpoints relative to it),
+# so If-None-Match is answered with a 304 without loading any movie
+# changes made by another process (e.g. `python -m sql_app.sync`) change the generation; get_db
+# notices them before the ETag is computed
+
+BOOT_ID = uuid.uuid4().hex[:8]
+CACHE_CONTROL = "no-cache" # clients may keep responses but must revalidate them
+
+# bumped by every committed catalog change (events.py) and box office reload
+class CatalogVersion:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def bump(self):
+        with self.lock:
+            self.value += 1
+
+    def added(self, movies: list):
+        self.bump()
+
+    def removed(self, movie_ids: list):
+        self.bump()
+
+    def cleared(self):
+        self.bump()
+
+    def boxoffice_reloaded(self):
+        self.bump()
+
+    def reloaded(self):
+        self.bump()
+
+catalog_version = events.subscribe(CatalogVersion())
+
+def make_etag(request: Request, *extra):
+    url = request.url.path + "?" + request.url.query
+    url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    parts = [BOOT_ID, str(catalog_version.value), str(database.known_generation),
+             *[str(part) for part in extra], url_hash]
+    return '"' + "-".join(parts) + '"'
+
+# weak comparison, as If-None-Match asks for
+def matches(if_none_match: str, tag: str):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == tag for candidate in if_none_match.split(","))
+
+# 304 when the client's copy is current, otherwise build() with the ETag headers added
+def conditional(request: Request, build, *extra):
+    tag = make_etag(request, *extra)
+    headers = {"ETag": tag, "Cache-Control": CACHE_CONTROL}
+    if matches(request.headers.get("if-none-match"), tag):
+        return Response(status_code=304, headers=headers)
+    response = build()
+    if isinstance(response, Response) and response.status_code == 200:
+        response.headers.update(headers)
+    return response
@@ -0,0 +1,46 @@
+from contextlib import nullcontext
+
+# in-process structures derived from the movies table (search index, caches, ...)
+# subscribe here and are notified by crud after each committed change
+# a listener may define any of:
+#   added(movies)  - new or replaced movies (models.Movie objects)
+#   removed(ids)   - ids of deleted movies
+#   cleared()      - every movie was deleted
+#   boxoffice_reloaded() - the box office file changed (boxoffice.py)
+#   reloaded()     - the structures were rebuilt from the database (the file was replaced, or the
+#                    changes of another process are no longer in its change log); caches drop
+#                    what they hold
+listeners = []
+
+def subscribe(listener):
+    listeners.append(listener)
+    return listener
+
+def notify(event: str, *args):
+    for listener in listeners:
+        handler = getattr(listener, event, None)
+        if handler is not None:
+            handler(*args)
+
+def movies_added(movies: list):
+    notify("added", movies)
+
+def movies_removed(movie_ids: list):
+    notify("removed", movie_ids)
+
+def catalog_cleared():
+    notify("cleared")
+
+def boxoffice_reloaded():
+    notify("boxoffice_reloaded")
+
+def catalog_reloaded():
+    notify("reloaded")
+
+# the state of a listener rebuilt into a fresh object replaces its own at once (under its lock),
+# so readers see the old or the new catalog, never a partly built one
+def replace_state(listener, fresh):
+    state = {name: value for name, value in vars(fresh).items() if name != "lock"}
+    lock = getattr(listener, "lock", None) or nullcontext()
+    with lock:
+        listener.__dict__.update(state)
@@ -0,0 +1,46 @@
+import zlib
+from typing import Union
+
+from . import crud, models
+from .database import SessionLocal
+from .render_cache import render
+
+# full catalog export as NDJSON (one movie per line), optionally gzip compressed
+# the movies are read from the database in chunks (yield_per) and written out as soon as
+# they are rendered, so memory use does not depend on the size of the catalog
+# the export has its own session: the response is still streaming after the request's session is closed
+
+CHUNK_SIZE = 1000 # rows fetched from the database at a time
+WRITE_SIZE = 64 * 1024 # bytes handed to the server at a time
+
+def movie_lines(genres: list[str], openyear: Union[int, None] = None, endyear: Union[int, None] = None):
+    db = SessionLocal()
+    try:
+        query = models.with_details(crud.filter_query(db, genres, openyear, endyear)).order_by(models.Movie.id)
+        for movie in query.yield_per(CHUNK_SIZE):
+            yield render(movie) + b"\n"
+    finally:
+        db.close()
+
+def buffered(lines):
+    buffer = bytearray()
+    for line in lines:
+        buffer += line
+        if len(buffer) >= WRITE_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits 31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_movies(genres: list[str], openyear: Union[int, None] = None, endyear: Union[int, None] = None,
+                  compress: bool = False):
+    chunks = buffered(movie_lines(genres, openyear, endyear))
+    return gzipped(chunks) if compress else chunks
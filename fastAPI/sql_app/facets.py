@@ -0,0 +1,119 @@
+import threading
+from collections import Counter
+from typing import Union
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from . import events, models
+
+# facet counts for the genre / release year filters of /movies/filter/
+# every movie is reduced to a (release year, genre bit mask) combination; the number of movies
+# per combination is kept up to date on insert and delete (events.py), so the facets of a
+# selection are computed from the few thousand combinations instead of the movies table
+# genre counts ignore the genre selection (they tell what selecting another genre would give),
+# year counts and totalCount apply the whole selection, like crud.filter_query
+# genres and years are listed in sorted order, the same in every worker whatever order it saw them in
+
+class FacetCounts:
+    def __init__(self):
+        self.bits = {} # genre -> bit
+        self.combos = Counter() # (year or None, genre mask) -> number of movies
+        self.movie_combos = {} # movie id -> its (year, mask)
+        self.lock = threading.Lock()
+
+    def mask(self, genres: list):
+        mask = 0
+        for genre in genres:
+            bit = self.bits.get(genre)
+            if bit is None:
+                bit = self.bits[genre] = len(self.bits)
+            mask |= 1 << bit
+        return mask
+
+    def add(self, movie_id: int, year: Union[int, None], genres: list):
+        self.remove(movie_id)
+        combo = (year, self.mask(genres))
+        self.movie_combos[movie_id] = combo
+        self.combos[combo] += 1
+
+    def remove(self, movie_id: int):
+        combo = self.movie_combos.pop(movie_id, None)
+        if combo is not None:
+            self.combos[combo] -= 1
+            if not self.combos[combo]:
+                del self.combos[combo]
+
+    def clear(self):
+        self.combos = Counter()
+        self.movie_combos = {}
+
+    # catalog events, see events.py
+    def added(self, movies: list):
+        with self.lock:
+            for movie in movies:
+                if movie.openDate is None:
+                    self.remove(movie.id)
+                    continue
+                open_date = models.parse_open_date(movie.openDate)
+                self.add(movie.id, open_date.year if open_date else None, movie.get_list_field("genre"))
+
+    def removed(self, movie_ids: list):
+        with self.lock:
+            for movie_id in movie_ids:
+                self.remove(movie_id)
+
+    def cleared(self):
+        with self.lock:
+            self.clear()
+
+    # rebuild the counts from the SQLite database (movie_genres join table and open_year column)
+    def build(self, db: Session):
+        genres = {}
+        for movie_id, genre in models.in_id_ranges(db.query(models.MovieGenre.movie_id, models.MovieGenre.genre), models.MovieGenre.movie_id):
+            genres.setdefault(movie_id, []).append(genre)
+        fresh = FacetCounts()
+        rows = db.query(models.Movie.id, models.Movie.open_year).filter(models.Movie.openDate != None)
+        for movie_id, year in models.in_id_ranges(rows, models.Movie.id):
+            fresh.add(movie_id, year, genres.get(movie_id, ()))
+        events.replace_state(self, fresh)
+
+    # the same counts from the arrays of the catalog snapshot (snapshot.py)
+    def load(self, snapshot):
+        fresh = FacetCounts()
+        genres, offsets, indices = snapshot.string_lists("genres")
+        offsets, indices = offsets.tolist(), indices.tolist()
+        movie_ids, years = snapshot.ids.tolist(), snapshot.years().tolist()
+        for slot in np.flatnonzero(snapshot.dated).tolist():
+            fresh.add(movie_ids[slot], years[slot] or None, [genres[index] for index in indices[offsets[slot]:offsets[slot + 1]]])
+        events.replace_state(self, fresh)
+
+    def facets(self, genres: Union[list[str], None] = None, openyear: Union[int, None] = None,
+               endyear: Union[int, None] = None):
+        low = openyear if openyear is not None and openyear > 1 else None
+        high = endyear if endyear is not None and endyear < 9999 else None
+        genre_counts = Counter()
+        year_counts = Counter()
+        total = 0
+        with self.lock:
+            bits = dict(self.bits)
+            selected = 0
+            for genre in genres or ():
+                selected |= 1 << bits[genre] if genre in bits else 0
+            for (year, mask), count in self.combos.items():
+                if low is not None or high is not None:
+                    if year is None or (low is not None and year < low) or (high is not None and year > high):
+                        continue
+                for genre, bit in bits.items():
+                    if mask >> bit & 1:
+                        genre_counts[genre] += count
+                if genres and not mask & selected:
+                    continue
+                total += count
+                if year is not None:
+                    year_counts[year] += count
+        return {"totalCount": total,
+                "genres": {genre: genre_counts[genre] for genre in sorted(bits) if genre_counts[genre]},
+                "years": {year: year_counts[year] for year in sorted(year_counts)}}
+
+facet_counts = events.subscribe(FacetCounts())
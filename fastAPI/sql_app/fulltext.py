@@ -0,0 +1,59 @@
+from sqlalchemy import Float, Integer, text
+
+# local full-text search over the catalog: SQLite FTS5 table movies_fts, rowid = movies.id
+# the trigram tokenizer matches any part of a word, which suits Korean titles / names
+CREATE_TABLE = ("CREATE VIRTUAL TABLE IF NOT EXISTS movies_fts "
+                "USING fts5(title, titleEng, plot, keywords, people, tokenize='trigram')")
+COLUMNS = ("title", "titleEng", "plot", "keywords", "people")
+# BM25 weight of each column: title matches count more than plot matches
+WEIGHTS = (10.0, 10.0, 1.0, 3.0, 5.0)
+
+INSERT = text("INSERT INTO movies_fts (rowid, title, titleEng, plot, keywords, people) "
+              "VALUES (:movie_id, :title, :titleEng, :plot, :keywords, :people)")
+
+# fields: title, titleEng, synopsis (dict) and the decoded keyword / people lists
+def fts_row(movie_id: int, fields: dict):
+    people = (fields.get("directors") or []) + (fields.get("actors") or []) + (fields.get("producer") or [])
+    return {"movie_id": movie_id,
+            "title": fields.get("title") or "",
+            "titleEng": fields.get("titleEng") or "",
+            "plot": (fields.get("synopsis") or {}).get("plotText") or "",
+            "keywords": " ".join(fields.get("keywords") or []),
+            "people": " ".join(people)}
+
+# db: a Session or a Connection
+def insert_rows(db, rows: list):
+    if rows:
+        db.execute(INSERT, rows)
+
+def delete_rows(db, movie_ids: list):
+    if movie_ids:
+        db.execute(text("DELETE FROM movies_fts WHERE rowid IN (%s)" % ",".join(str(int(movie_id)) for movie_id in movie_ids)))
+
+def delete_all(db):
+    db.execute(text("DELETE FROM movies_fts"))
+
+def quote(term: str):
+    return '"' + term.replace('"', '""') + '"'
+
+# subquery of the movies matching q: (movie_id, rank), a lower rank is a better match
+# words of 3+ characters go through the trigram index and are ranked with BM25;
+# shorter words can not use trigrams and fall back to LIKE on the indexed text
+def match_query(q: str):
+    terms = q.split()
+    long_terms = [term for term in terms if len(term) >= 3]
+    short_terms = [term for term in terms if len(term) < 3]
+    params = {}
+    where = []
+    if long_terms:
+        where.append("movies_fts MATCH :match")
+        params["match"] = " AND ".join(quote(term) for term in long_terms)
+    for number, term in enumerate(short_terms):
+        name = f"like{number}"
+        where.append("(" + " OR ".join(f"{column} LIKE :{name} ESCAPE '\\'" for column in COLUMNS) + ")")
+        params[name] = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    rank = f"bm25(movies_fts, {', '.join(map(str, WEIGHTS))})" if long_terms else "0.0"
+    if not where:
+        where.append("0")
+    sql = f"SELECT rowid AS movie_id, {rank} AS rank FROM movies_fts WHERE " + " AND ".join(where)
+    return text(sql).bindparams(**params).columns(movie_id=Integer, rank=Float).subquery("fts")
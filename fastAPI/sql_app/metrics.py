@@ -0,0 +1,121 @@
+import bisect
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# request and phase latency histograms, exposed in the Prometheus text format at /metrics
+# phases: "db" (SQLite queries), "dataverse" (HTTP calls), "boxoffice_csv" (KOBIS file loading),
+# "json_encode" (rendering movies); they are attributed to the route of the request they ran in
+
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "0")) # 0: no slow request log
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self, name: str, help: str, label_names: tuple):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.series = {} # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, labels: tuple, seconds: float):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * len(BUCKETS) + [0.0, 0]
+            bucket = bisect.bisect_left(BUCKETS, seconds)
+            if bucket < len(BUCKETS):
+                series[bucket] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        for labels, values in sorted(series.items()):
+            label_text = ",".join(f'{name}="{escape(value)}"' for name, value in zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(BUCKETS, values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {values[-1]}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {values[-2]}")
+            lines.append(f"{self.name}_count{{{label_text}}} {values[-1]}")
+        return "\n".join(lines)
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+request_seconds = Histogram("smdb_request_seconds", "Request latency by route", ("method", "route", "status"))
+phase_seconds = Histogram("smdb_phase_seconds", "Time spent in each phase of a request", ("route", "phase"))
+
+# time per phase during the current request: {phase: seconds}
+current_phases = contextvars.ContextVar("current_phases", default=None)
+
+def record(phase: str, seconds: float):
+    phases = current_phases.get()
+    if phases is None:
+        phase_seconds.observe(("", phase), seconds)
+    else:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+@contextmanager
+def span(phase: str):
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - began)
+
+# times every SQL statement of the engine as the "db" phase
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        record("db", time.perf_counter() - conn.info["query_started"].pop())
+
+# ASGI middleware function for app.middleware("http")
+async def timing_middleware(request, call_next):
+    phases = {}
+    token = current_phases.set(phases)
+    began = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        seconds = time.perf_counter() - began
+        current_phases.reset(token)
+        route = getattr(request.scope.get("route"), "path", None) or "unmatched"
+        request_seconds.observe((request.method, route, str(status)), seconds)
+        totals = dict(phases)
+        for phase, phase_time in totals.items():
+            phase_seconds.observe((route, phase), phase_time)
+        if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+            logger.warning("slow request %s %s params=%s status=%s %.1fms phases=%s", request.method, route,
+                           dict(request.query_params), status, seconds * 1000,
+                           {phase: round(phase_time * 1000, 1) for phase, phase_time in totals.items()})
+
+# extra counters: name -> (help, function returning {label value: number})
+counters = {}
+
+def render():
+    parts = [request_seconds.render(), phase_seconds.render()]
+    for name, (help, values) in counters.items():
+        lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+        for label, value in values().items():
+            lines.append(f'{name}{{name="{escape(label)}"}} {value}')
+        parts.append("\n".join(lines))
+    return "\n".join(parts) + "\n"
@@ -0,0 +1,104 @@
+import json
+
+from sqlalchemy import bindparam, insert, select, text
+from sqlalchemy.engine import Engine
+
+from . import fulltext, models
+from .database import engine
+
+# one-off schema / data migrations of an existing sql_app.db
+# applied migrations are recorded in schema_migrations so each one runs only once
+
+def backfill_join_tables(conn):
+    movies = models.Movie.__table__
+    rows = conn.execute(select(movies.c.id, movies.c.genre, movies.c.directors, movies.c.actors,
+                               movies.c.producer, movies.c.keywords))
+    batch = ([], [], [])
+    for row in rows:
+        fields = {field: models.decode_list(getattr(row, field))
+                  for field in ("genre", "directors", "actors", "producer", "keywords")}
+        for rows_of_table, new_rows in zip(batch, models.link_rows(row.id, fields)):
+            rows_of_table.extend(new_rows)
+    for table, table_rows in zip((models.MovieGenre, models.MoviePerson, models.MovieKeyword), batch):
+        if table_rows:
+            conn.execute(insert(table.__table__), table_rows)
+
+def column_names(conn, table: str):
+    return {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+
+def add_plot_hash(conn):
+    if "plot_hash" not in column_names(conn, "movies"):
+        conn.execute(text("ALTER TABLE movies ADD COLUMN plot_hash VARCHAR"))
+    rows = conn.execute(text("SELECT id, synopsis FROM movies")).fetchall()
+    updates = [{"id": row.id, "plot_hash": models.plot_hash(json.loads(row.synopsis) if row.synopsis else {})}
+               for row in rows]
+    if updates:
+        conn.execute(text("UPDATE movies SET plot_hash = :plot_hash WHERE id = :id"), updates)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_movies_title_plot_hash ON movies (title, plot_hash)"))
+
+# uploads are de-duplicated on (title, titleEng, openDate, runningTimeMinute);
+# rows repeating an earlier row's fingerprint are dropped before the unique index is built
+def add_fingerprint_index(conn):
+    duplicates = """SELECT id FROM movies WHERE id NOT IN (
+                        SELECT min(id) FROM movies GROUP BY title, titleEng, openDate, runningTimeMinute)"""
+    for table in ("movie_genre", "movie_person", "movie_keyword"):
+        conn.execute(text(f"DELETE FROM {table} WHERE movie_id IN ({duplicates})"))
+    conn.execute(text(f"DELETE FROM movies WHERE id IN ({duplicates})"))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ux_movies_fingerprint "
+                      "ON movies (title, \"titleEng\", \"openDate\", \"runningTimeMinute\")"))
+
+def add_open_date(conn):
+    columns = column_names(conn, "movies")
+    if "open_date" not in columns:
+        conn.execute(text("ALTER TABLE movies ADD COLUMN open_date DATE"))
+    if "open_year" not in columns:
+        conn.execute(text("ALTER TABLE movies ADD COLUMN open_year INTEGER"))
+    movies = models.Movie.__table__
+    rows = conn.execute(select(movies.c.id, movies.c.openDate)).fetchall()
+    updates = [dict(models.open_date_columns(row.openDate), movie_id=row.id) for row in rows]
+    if updates:
+        conn.execute(movies.update().where(movies.c.id == bindparam("movie_id")), updates)
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_movies_open_date ON movies (open_date, id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_movies_open_year ON movies (open_year)"))
+
+def add_fulltext(conn):
+    conn.execute(text(fulltext.CREATE_TABLE))
+    fulltext.delete_all(conn)
+    movies = models.Movie.__table__
+    rows = conn.execute(select(movies.c.id, movies.c.title, movies.c.titleEng, movies.c.synopsis, movies.c.keywords,
+                               movies.c.directors, movies.c.actors, movies.c.producer))
+    fts_rows = []
+    for row in rows:
+        fields = {"title": row.title, "titleEng": row.titleEng,
+                  "synopsis": models.decode_dict(row.synopsis)}
+        for field in ("keywords", "directors", "actors", "producer"):
+            fields[field] = models.decode_list(getattr(row, field))
+        fts_rows.append(fulltext.fts_row(row.id, fields))
+    fulltext.insert_rows(conn, fts_rows)
+
+def add_catalog_generation(conn):
+    conn.execute(text("INSERT OR IGNORE INTO catalog_generation (id, value) VALUES (1, 0)"))
+
+# (name, function) in the order they have to be applied
+MIGRATIONS = [
+    ("0001_join_tables", backfill_join_tables),
+    ("0002_plot_hash", add_plot_hash),
+    ("0003_fingerprint_index", add_fingerprint_index),
+    ("0004_open_date", add_open_date),
+    ("0005_fulltext", add_fulltext),
+    ("0006_catalog_generation", add_catalog_generation),
+]
+
+def migrate(bind: Engine = engine):
+    models.Base.metadata.create_all(bind=bind)
+    with bind.begin() as conn:
+        conn.execute(text("CREATE TABLE IF NOT EXISTS schema_migrations (name VARCHAR PRIMARY KEY)"))
+        applied = {row[0] for row in conn.execute(text("SELECT name FROM schema_migrations"))}
+        for name, migration in MIGRATIONS:
+            if name in applied:
+                continue
+            migration(conn)
+            conn.execute(text("INSERT INTO schema_migrations (name) VALUES (:name)"), {"name": name})
+
+if __name__ == "__main__":
+    migrate()
@@ -1,41 +1,192 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
-from sqlalchemy.orm import relationship
+from sqlalchemy import Boolean, Column, Date, ForeignKey, Index, Integer, String, func
+from sqlalchemy.orm import deferred, relationship, undefer_group
+from sqlalchemy.types import TypeDecorator
 
 from .database import Base
+import datetime
+import hashlib
 import json
 
+def decode_list(value):
+    if not value:
+        return []
+    return json.loads(value) if isinstance(value, str) else value
+
+def decode_dict(value):
+    if not value:
+        return {}
+    return json.loads(value) if isinstance(value, str) else value
+
+# list / dict stored as JSON text (non-ASCII kept as is); decoded once when the column is loaded,
+# so deferred columns are only decoded when they are used
+# strings are taken as already encoded JSON
+class JSONText(TypeDecorator):
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, str):
+            return value
+        return json.dumps(value, ensure_ascii=False)
+
+    def process_result_value(self, value, dialect):
+        return json.loads(value) if value else None
+
+# fingerprint of synopsis.plotText, used to match Dataverse datasets to rows
+def plot_hash(synopsis):
+    plot_text = (synopsis or {}).get("plotText") or ""
+    return hashlib.sha1(plot_text.encode("utf-8")).hexdigest()
+
+# openDate is "YYYY.MM.DD"; empty or malformed dates give None
+def parse_open_date(open_date):
+    try:
+        return datetime.datetime.strptime((open_date or "").strip(), "%Y.%m.%d").date()
+    except ValueError:
+        return None
+
+# derived release date columns of a movie row
+def open_date_columns(open_date):
+    date = parse_open_date(open_date)
+    return {"open_date": date, "open_year": date.year if date else None}
+
+# columns sent to clients as they are / stored as JSON lists
+TEXT_FIELDS = ("id", "title", "titleEng", "openDate", "runningTimeMinute")
+LIST_FIELDS = ("genre", "directors", "distributor", "posterUrl", "actors", "producer", "keywords", "vodUrl")
+
+# columns identifying a movie when uploads are de-duplicated
+FINGERPRINT = ("title", "titleEng", "openDate", "runningTimeMinute")
+
+# the "detail" columns are only needed for whole movies (detail pages, full lists, the in-memory indexes)
+# and are loaded by queries going through with_details(); list cards do without them
 class Movie(Base):
     __tablename__ = 'movies'
     
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String)
     titleEng = Column(String)
-    genre = Column(String)
-    synopsis = Column(String)
+    genre = Column(JSONText)
+    synopsis = deferred(Column(JSONText), group="detail")
     openDate = Column(String)
     runningTimeMinute = Column(String)
-    actors = Column(String)
-    directors = Column(String)
-    producer = Column(String)
-    distributor = Column(String)
-    keywords = Column(String)
-    posterUrl = Column(String)
-    vodUrl = Column(String)
+    actors = deferred(Column(JSONText), group="detail")
+    directors = deferred(Column(JSONText), group="detail")
+    producer = deferred(Column(JSONText), group="detail")
+    distributor = deferred(Column(JSONText), group="detail")
+    keywords = deferred(Column(JSONText), group="detail")
+    posterUrl = Column(JSONText)
+    vodUrl = deferred(Column(JSONText), group="detail")
+    # derived columns are deferred so they are not part of the movie data sent to clients
+    plot_hash = deferred(Column(String))
+    open_date = deferred(Column(Date))
+    open_year = deferred(Column(Integer, index=True))
+
+    __table_args__ = (Index('ix_movies_title_plot_hash', 'title', 'plot_hash'),
+                      Index('ix_movies_open_date', 'open_date', 'id'),
+                      Index('ux_movies_fingerprint', 'title', 'titleEng', 'openDate', 'runningTimeMinute', unique=True))
 
     def set_list_field(self, field_name, data_list):
-        current_data = self.get_list_field(field_name)
-        current_data.extend(data_list)
-        setattr(self, field_name, json.dumps(current_data, ensure_ascii=False))
+        setattr(self, field_name, self.get_list_field(field_name) + list(data_list))
 
     def set_dict_field(self, field_name, data_dict):
-        current_data = self.get_dict_field(field_name)
-        current_data.update(data_dict)
-        setattr(self, field_name, json.dumps(current_data, ensure_ascii=False))
+        setattr(self, field_name, {**self.get_dict_field(field_name), **data_dict})
 
     def get_list_field(self, field_name):
-        field_value = getattr(self, field_name)
-        return json.loads(field_value) if field_value else []
+        return decode_list(getattr(self, field_name))
+
+    # the movie as sent to clients, with decoded list / dict fields
+    def to_dict(self):
+        movie = {field_name: getattr(self, field_name) for field_name in TEXT_FIELDS}
+        for field_name in LIST_FIELDS:
+            movie[field_name] = self.get_list_field(field_name)
+        movie["synopsis"] = self.get_dict_field("synopsis")
+        return movie
 
     def get_dict_field(self, field_name):
-        field_value = getattr(self, field_name)
-        return json.loads(field_value) if field_value else {}
\ No newline at end of file
+        return decode_dict(getattr(self, field_name))
+
+# query loading whole movies, deferred "detail" columns included
+def with_details(query):
+    return query.options(undefer_group("detail"))
+
+# rows of a query, read in ranges of movie ids (column) as short statements: a cursor kept open
+# over the whole table holds the shared lock of the file, and a writer waiting on it keeps every
+# reader out (rollback journal); used by the builds of the in-memory structures, which run next to
+# the writes (database.check_generation)
+def in_id_ranges(query, column, size: int = 10000):
+    last = query.session.query(func.max(Movie.id)).scalar() or 0
+    for low in range(0, last, size):
+        yield from query.filter(column > low, column <= low + size).all()
+
+# normalized list fields, so genre / people / keyword filters can run as indexed SQL
+class MovieGenre(Base):
+    __tablename__ = 'movie_genre'
+
+    movie_id = Column(Integer, ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True)
+    genre = Column(String, primary_key=True)
+
+    __table_args__ = (Index('ix_movie_genre_genre', 'genre', 'movie_id'),)
+
+class MoviePerson(Base):
+    __tablename__ = 'movie_person'
+
+    movie_id = Column(Integer, ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True)
+    role = Column(String, primary_key=True) # director / actor / producer
+    name = Column(String, primary_key=True)
+
+    __table_args__ = (Index('ix_movie_person_name', 'name', 'role', 'movie_id'),)
+
+class MovieKeyword(Base):
+    __tablename__ = 'movie_keyword'
+
+    movie_id = Column(Integer, ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True)
+    keyword = Column(String, primary_key=True)
+
+    __table_args__ = (Index('ix_movie_keyword_keyword', 'keyword', 'movie_id'),)
+
+# Dataverse -> SQLite sync (sync.py): the dataset each movie comes from and the hash of its description
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+
+    global_id = Column(String, primary_key=True)
+    description_hash = Column(String)
+    movie_id = Column(Integer, index=True)
+    seen_run = Column(Integer) # last sync run that saw the dataset
+
+# progress of the sync run in progress, so an interrupted run resumes where it stopped
+class SyncCheckpoint(Base):
+    __tablename__ = 'sync_checkpoint'
+
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer)
+    next_start = Column(Integer)
+    started_at = Column(String)
+
+# generation of the catalog, bumped by every transaction changing it (database.check_generation)
+class CatalogGeneration(Base):
+    __tablename__ = 'catalog_generation'
+
+    id = Column(Integer, primary_key=True)
+    value = Column(Integer, nullable=False)
+
+# ids of the movies each generation added, replaced or deleted (movie_id NULL: every movie was
+# deleted), so the other processes apply the same changes (database.check_generation)
+class CatalogChange(Base):
+    __tablename__ = 'catalog_changes'
+
+    id = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False, index=True)
+    movie_id = Column(Integer)
+
+# movie list field -> person role stored in movie_person
+PERSON_ROLES = {"directors": "director", "actors": "actor", "producer": "producer"}
+
+# join table rows (as dicts) for one movie; fields maps list field name -> decoded list
+def link_rows(movie_id, fields):
+    genre_rows = [{"movie_id": movie_id, "genre": genre}
+                  for genre in dict.fromkeys(fields.get("genre") or []) if genre]
+    person_rows = [{"movie_id": movie_id, "role": role, "name": name}
+                   for field, role in PERSON_ROLES.items()
+                   for name in dict.fromkeys(fields.get(field) or []) if name]
+    keyword_rows = [{"movie_id": movie_id, "keyword": keyword}
+                    for keyword in dict.fromkeys(fields.get("keywords") or []) if keyword]
+    return genre_rows, person_rows, keyword_rows
@@ -0,0 +1,171 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import closing, contextmanager
+
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.schema import CreateTable
+
+from . import crud, database, fulltext, migrations, models, schemas
+from .database import engine
+
+# zero-downtime catalog rebuild
+# - the new catalog is loaded into a shadow database file next to the live one: tables without
+#   their secondary indexes, movies de-duplicated in memory and inserted in executemany batches
+# - the indexes are built once everything is loaded, then the file replaces the live one with
+#   os.replace (atomic rename); readers see either the old or the new catalog, never a partial one
+# - the shadow file is synced to disk first, then writers are held off for the swap only
+#   (database.write_lock in this process, a RESERVED lock on the live file for the others; readers
+#   go on), so no write is lost in the replaced file
+# - connections opened on the old file finish their query on it; pooled ones are opened again on
+#   their next checkout (database.py), and database.check_generation() rebuilds the in-memory
+#   structures in the background from the next request on, also when the rebuild ran in another
+#   process
+# the sync state is not carried over: the next sync run links the datasets to the new rows again
+# usage: python -m sql_app.rebuild movies.ndjson
+
+lock = threading.Lock() # one rebuild at a time in this process
+
+LOCK_TIMEOUT = 60 # seconds waited for the writers of the live file to finish
+
+# transaction on the live database file: BEGIN IMMEDIATE waits for the writers of every process and
+# holds off new ones while readers go on, a journal left by a failed write being rolled back first;
+# yields the connection, None when there is no live file yet
+@contextmanager
+def live_file(path: str, begin: str = "BEGIN IMMEDIATE"):
+    if not os.path.exists(path):
+        yield None
+        return
+    with closing(sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None)) as conn:
+        conn.execute(begin)
+        try:
+            yield conn
+        finally:
+            conn.execute("ROLLBACK")
+
+def live_generation(conn):
+    if conn is None:
+        return 0
+    try:
+        row = conn.execute("SELECT value FROM catalog_generation WHERE id = 1").fetchone()
+    except sqlite3.OperationalError: # file from before the catalog_generation migration
+        return 0
+    return row[0] if row else 0
+
+class CatalogRebuild:
+    def __init__(self, path: str = None):
+        self.path = path or engine.url.database
+        self.shadow_path = self.path + ".rebuild"
+        if os.path.exists(self.shadow_path):
+            os.remove(self.shadow_path)
+        self.engine = create_engine(f"sqlite:///{self.shadow_path}")
+        self.conn = self.engine.connect()
+        # the shadow file is thrown away if anything fails, so it needs no journal
+        self.conn.exec_driver_sql("PRAGMA journal_mode=OFF")
+        self.conn.exec_driver_sql("PRAGMA synchronous=OFF")
+        for table in models.Base.metadata.sorted_tables:
+            self.conn.execute(CreateTable(table))
+        self.conn.execute(text(fulltext.CREATE_TABLE))
+        self.seen = set()
+        self.next_id = 1
+        self.report = {"inserted": 0, "skipped": 0}
+
+    def add(self, batch: list[schemas.Movie]):
+        movies, links, fts_rows = [], ([], [], []), []
+        for data in batch:
+            key = crud.fingerprint(data)
+            if key in self.seen:
+                self.report["skipped"] += 1
+                continue
+            self.seen.add(key)
+            movie_id = self.next_id
+            self.next_id += 1
+            movies.append(dict(crud.movie_row(data), id=movie_id))
+            for rows, new_rows in zip(links, models.link_rows(movie_id, crud.link_fields(data))):
+                rows.extend(new_rows)
+            fts_rows.append(crud.fts_row(movie_id, data))
+        if movies:
+            self.conn.execute(insert(models.Movie), movies)
+        for table, rows in zip((models.MovieGenre, models.MoviePerson, models.MovieKeyword), links):
+            if rows:
+                self.conn.execute(insert(table), rows)
+        fulltext.insert_rows(self.conn, fts_rows)
+        self.report["inserted"] += len(movies)
+
+    # build the indexes, then swap the shadow file in
+    def finish(self):
+        for table in models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(self.conn)
+        self.conn.execute(text("CREATE TABLE schema_migrations (name VARCHAR PRIMARY KEY)"))
+        self.conn.execute(text("INSERT INTO schema_migrations (name) VALUES (:name)"),
+                          [{"name": name} for name, migration in migrations.MIGRATIONS])
+        # the generation goes on from the live file's, so every process sees a new one
+        with live_file(self.path, "BEGIN") as live:
+            generation = live_generation(live) + 1
+        self.conn.execute(text("INSERT INTO catalog_generation (id, value) VALUES (1, :value)"),
+                          {"value": generation})
+        self.conn.commit()
+        self.conn.exec_driver_sql("ANALYZE")
+        self.conn.commit()
+        self.sync()
+        # from here to the swap no write of the live file is in progress or can start: the writers of
+        # this process hold database.write_lock for their whole transaction, the other processes are
+        # held off by the RESERVED lock; so no commit lands in the file being replaced and no journal
+        # of it is left to be replayed into the new one
+        with database.write_lock, live_file(self.path) as live:
+            # a write committed since the generation was read: the new file's one is moved past it
+            if live_generation(live) + 1 != generation:
+                self.conn.execute(text("UPDATE catalog_generation SET value = :value WHERE id = 1"),
+                                  {"value": live_generation(live) + 1})
+                self.conn.commit()
+                self.sync()
+            self.close()
+            os.replace(self.shadow_path, self.path)
+            # writers resume on connections to the new file
+            database.file_replaced()
+        return self.report
+
+    # the shadow file to disk; after the first call only the pages written since are left to sync
+    def sync(self):
+        with open(self.shadow_path, "rb+") as f:
+            os.fsync(f.fileno())
+
+    def abort(self):
+        self.conn.rollback()
+        self.close()
+        if os.path.exists(self.shadow_path):
+            os.remove(self.shadow_path)
+
+    def close(self):
+        self.conn.close()
+        self.engine.dispose()
+
+def rebuild_catalog(movies, batch_size: int = crud.BULK_BATCH_SIZE, path: str = None):
+    with lock:
+        loader = CatalogRebuild(path)
+        try:
+            batch = []
+            for data in movies:
+                batch.append(data)
+                if len(batch) >= batch_size:
+                    loader.add(batch)
+                    batch = []
+            loader.add(batch)
+            return loader.finish()
+        except BaseException:
+            loader.abort()
+            raise
+
+if __name__ == "__main__":
+    def read_movies(file_name):
+        with open(file_name, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield schemas.Movie(**json.loads(line))
+
+    if len(sys.argv) != 2:
+        sys.exit("usage: python -m sql_app.rebuild movies.ndjson")
+    print(rebuild_catalog(read_movies(sys.argv[1])))
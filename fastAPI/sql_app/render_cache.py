@@ -0,0 +1,116 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from sqlalchemy.orm import Session
+
+from . import events, metrics, models, schemas
+
+CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "100000"))
+
+def render(movie: models.Movie):
+    with metrics.span("json_encode"):
+        return json.dumps(movie.to_dict(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def load_movies(db: Session, movie_ids: list):
+    return models.with_details(db.query(models.Movie)).filter(models.Movie.id.in_(movie_ids))
+
+# list card (schemas.MovieCard) of a movie or of a card_columns row
+def render_card(movie):
+    with metrics.span("json_encode"):
+        return schemas.MovieCard.model_validate(movie, from_attributes=True).model_dump_json().encode("utf-8")
+
+def load_cards(db: Session, movie_ids: list):
+    columns = [getattr(models.Movie, field) for field in schemas.MovieCard.model_fields]
+    return db.query(*columns).filter(models.Movie.id.in_(movie_ids))
+
+# movie id -> the movie's JSON bytes, so endpoints can send cached movies without
+# touching the ORM; entries are dropped when the movie is inserted again or deleted
+# render turns a loaded movie into JSON, load(db, ids) queries the movies missing from the cache
+# source(ids), when set, is asked first ({id: JSON}, e.g. the catalog snapshot) and is not copied in
+# generation counts the catalog events, so movies loaded while a change was applied are not kept
+class RenderCache:
+    def __init__(self, render=render, load=load_movies, maxsize: int = CACHE_SIZE):
+        self.render = render
+        self.load = load
+        self.source = None
+        self.maxsize = maxsize
+        self.fragments = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def put(self, movie_id: int, fragment: bytes, generation: int):
+        with self.lock:
+            # loaded under an older generation (a change was committed meanwhile): not kept
+            if generation != self.generation:
+                return
+            self.fragments[movie_id] = fragment
+            self.fragments.move_to_end(movie_id)
+            while len(self.fragments) > self.maxsize:
+                self.fragments.popitem(last=False)
+
+    # JSON of an already loaded movie; generation is self.generation as read before it was loaded
+    def fragment(self, movie: models.Movie, generation: int):
+        fragment = self.fragments.get(movie.id)
+        if fragment is None:
+            fragment = self.render(movie)
+            self.put(movie.id, fragment, generation)
+        return fragment
+
+    # JSON of the movies in the order of ids; missing movies are loaded with one query and skipped if deleted
+    def get_many(self, db: Session, movie_ids: list):
+        records = self.source(movie_ids) if self.source is not None else {}
+        missing = [movie_id for movie_id in movie_ids if movie_id not in records and movie_id not in self.fragments]
+        if missing:
+            generation = self.generation
+            for movie in self.load(db, missing):
+                records[movie.id] = self.render(movie)
+                self.put(movie.id, records[movie.id], generation)
+        fragments = []
+        with self.lock:
+            for movie_id in movie_ids:
+                fragment = records.get(movie_id)
+                if fragment is not None:
+                    fragments.append(fragment)
+                    continue
+                fragment = self.fragments.get(movie_id)
+                if fragment is not None:
+                    self.fragments.move_to_end(movie_id)
+                    fragments.append(fragment)
+        return fragments
+
+    # catalog events, see events.py
+    def added(self, movies: list):
+        self.removed([movie.id for movie in movies])
+
+    def removed(self, movie_ids: list):
+        with self.lock:
+            self.generation += 1
+            for movie_id in movie_ids:
+                self.fragments.pop(movie_id, None)
+
+    def cleared(self):
+        with self.lock:
+            self.generation += 1
+            self.fragments.clear()
+
+    def reloaded(self):
+        self.cleared()
+
+render_cache = events.subscribe(RenderCache())
+card_cache = events.subscribe(RenderCache(render_card, load_cards))
+
+def cache_for(view: schemas.View):
+    return card_cache if view == schemas.View.card else render_cache
+
+# a JSON object with the fields of meta and "data": the list of fragments
+def list_body(meta: dict, fragments: list):
+    with metrics.span("json_encode"):
+        return join_body(meta, fragments)
+
+def join_body(meta: dict, fragments: list):
+    head = json.dumps(meta, ensure_ascii=False, separators=(",", ":"))[:-1].encode("utf-8")
+    if meta:
+        head += b","
+    return head + b'"data":[' + b",".join(fragments) + b"]}"
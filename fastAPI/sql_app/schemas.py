@@ -1,4 +1,18 @@
 from pydantic import BaseModel
+from typing import Union
+from enum import Enum
+
+class Genre(str, Enum):
+    action = "액션"
+    drama = "드라마"
+    comedy = "코미디"
+    thriller = "스릴러"
+    fantasy = "SF/판타지"
+    romance = "로맨스"
+    adventure = "어드벤처"
+    horror = "공포"
+    crime = "범죄"
+    animation = "애니메이션"
 
 class MovieBase(BaseModel):
     title: str
@@ -18,4 +32,22 @@ class Movie(MovieBase):
     vodUrl: list[list[str]]
 
 class MovieCreate(Movie):
-    pass
\ No newline at end of file
+    pass
+
+# response shape of the list endpoints: whole movies, or cards with what a movie list shows
+class View(str, Enum):
+    full = "full"
+    card = "card"
+
+# screening status filter of /movies/filter/ (sql_app/screening.py)
+class Status(str, Enum):
+    onscreen = "onscreen"
+    offscreen = "offscreen"
+    comingsoon = "comingsoon"
+
+class MovieCard(BaseModel):
+    id: int
+    title: Union[str, None] = None
+    posterUrl: Union[list[str], None] = None
+    genre: Union[list[str], None] = None
+    openDate: Union[str, None] = None
@@ -0,0 +1,147 @@
+import asyncio
+import bisect
+import datetime
+import logging
+import threading
+from array import array
+from typing import Union
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+from . import crud, database, models
+from .boxoffice import boxoffice
+from .database import SessionLocal
+from .snapshot import snapshot_reader
+
+# screening status partitions: the ids of the onscreen, offscreen and comingsoon movies,
+# in the (open_date desc, id desc) order of crud.paginate, computed with one index scan
+# per (date, box office version, catalog generation) and served page by page from memory
+# - onscreen: movies of the box office list
+# - comingsoon: released after today
+# - offscreen: released before today and not on screen
+# the catalog generation is the one shared by the processes (database.py): writes of any process count
+# the id / release date arrays of the catalog snapshot are used instead of the scan when it is current
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ("onscreen", "offscreen", "comingsoon")
+
+# ids and release dates (date ordinals, 0 when unknown) of one partition, sorted
+class Partition:
+    def __init__(self):
+        self.ids = array("q")
+        self.ordinals = array("l")
+
+    def append(self, movie_id: int, ordinal: int):
+        self.ids.append(movie_id)
+        self.ordinals.append(ordinal)
+
+    def __len__(self):
+        return len(self.ids)
+
+    # position in the order: known dates, newest first, then unknown dates; ids descending
+    def sort_key(self, position: int):
+        ordinal = self.ordinals[position]
+        return (ordinal == 0, -ordinal, -self.ids[position])
+
+    # same page as crud.paginate would return for the partition's query
+    def page(self, page: int = 1, per_page: int = 15, cursor: Union[str, None] = None):
+        if cursor is not None:
+            open_date, movie_id = crud.parse_cursor(cursor)
+            ordinal = open_date.toordinal() if open_date else 0
+            start = bisect.bisect_right(range(len(self)), (ordinal == 0, -ordinal, -movie_id), key=self.sort_key)
+        else:
+            start = max(page - 1, 0) * per_page
+        end = min(start + per_page, len(self))
+
+        to_return = {}
+        to_return['totalCount'] = len(self)
+        to_return['isLast'] = end >= len(self)
+        to_return['ids'] = self.ids[start:end].tolist()
+        to_return['nextCursor'] = None
+        if not to_return['isLast']:
+            ordinal = self.ordinals[end - 1]
+            open_date = datetime.date.fromordinal(ordinal).strftime("%Y.%m.%d") if ordinal else ""
+            to_return['nextCursor'] = f"{open_date}|{self.ids[end - 1]}"
+        return to_return
+
+    @classmethod
+    def from_arrays(cls, ids, ordinals):
+        partition = cls()
+        partition.ids.frombytes(ids.astype(np.int64).tobytes())
+        partition.ordinals.frombytes(ordinals.astype(partition.ordinals.typecode).tobytes())
+        return partition
+
+def compute_from_snapshot(snapshot, onscreen_ids: frozenset, today_ordinal: int):
+    ids = snapshot.ids
+    ordinals = snapshot.ordinals.astype(np.int64)
+    order = np.lexsort((-ids, -ordinals, ordinals == 0))
+    ids, ordinals = ids[order], ordinals[order]
+    onscreen = np.isin(ids, np.fromiter(onscreen_ids, dtype=np.int64, count=len(onscreen_ids)))
+    masks = {"onscreen": onscreen,
+             "comingsoon": ordinals > today_ordinal,
+             "offscreen": (ordinals > 0) & (ordinals < today_ordinal) & ~onscreen}
+    return {status: Partition.from_arrays(ids[masks[status]], ordinals[masks[status]]) for status in STATUSES}
+
+def compute(db: Session, today: datetime.date):
+    onscreen_ids = boxoffice.movie_ids(db)
+    today_ordinal = today.toordinal()
+    snapshot = snapshot_reader.current()
+    if snapshot is not None:
+        return compute_from_snapshot(snapshot, onscreen_ids, today_ordinal)
+    partitions = {status: Partition() for status in STATUSES}
+    rows = db.query(models.Movie.id, models.Movie.open_date) \
+        .order_by(models.Movie.open_date.desc(), models.Movie.id.desc())
+    for movie_id, open_date in rows.yield_per(10000):
+        ordinal = open_date.toordinal() if open_date else 0
+        if movie_id in onscreen_ids:
+            partitions["onscreen"].append(movie_id, ordinal)
+        if ordinal > today_ordinal:
+            partitions["comingsoon"].append(movie_id, ordinal)
+        elif ordinal and ordinal < today_ordinal and movie_id not in onscreen_ids:
+            partitions["offscreen"].append(movie_id, ordinal)
+    return partitions
+
+class ScreeningStatus:
+    def __init__(self):
+        self.state = (None, None) # (key, partitions), swapped as a whole
+        self.lock = threading.Lock()
+
+    def current_key(self):
+        boxoffice.check()
+        return (datetime.date.today(), boxoffice.version, database.known_generation)
+
+    def get(self, db: Session, status: str):
+        key = self.current_key()
+        state_key, partitions = self.state
+        if state_key != key:
+            with self.lock:
+                state_key, partitions = self.state
+                if state_key != key:
+                    partitions = compute(db, key[0])
+                    self.state = (key, partitions)
+        return partitions[status]
+
+    def page(self, db: Session, status: str, page: int = 1, per_page: int = 15, cursor: Union[str, None] = None):
+        return self.get(db, status).page(page, per_page, cursor)
+
+    def refresh(self):
+        db = SessionLocal()
+        try:
+            self.get(db, "onscreen")
+        finally:
+            db.close()
+
+screening = ScreeningStatus()
+
+# recompute the partitions right after every midnight, so the first request of the day does not wait
+async def refresh_at_midnight():
+    while True:
+        now = datetime.datetime.now()
+        midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+        await asyncio.sleep((midnight - now).total_seconds() + 1)
+        try:
+            await asyncio.to_thread(screening.refresh)
+        except Exception:
+            logger.exception("screening status refresh failed")
@@ -0,0 +1,84 @@
+from sqlalchemy.orm import Session
+
+from . import events, models
+
+# fields of a movie that are searchable by exact term
+LIST_FIELDS = ["directors", "actors", "keywords"]
+TEXT_FIELDS = ["title", "titleEng"]
+
+def normalize(term: str):
+    return term.strip().casefold()
+
+def movie_terms(movie: models.Movie):
+    terms = set()
+    for field in LIST_FIELDS:
+        for value in movie.get_list_field(field):
+            if value:
+                terms.add(normalize(value))
+    for field in TEXT_FIELDS:
+        value = getattr(movie, field)
+        if value:
+            terms.add(normalize(value))
+    return terms
+
+# in-memory inverted index: search term -> ids of the movies containing it
+class SearchIndex:
+    def __init__(self):
+        self.postings = {}
+        self.terms_by_movie = {}
+
+    def add(self, movie: models.Movie):
+        self.add_terms(movie.id, movie_terms(movie))
+
+    def add_terms(self, movie_id: int, terms: set):
+        self.remove(movie_id)
+        for term in terms:
+            self.postings.setdefault(term, set()).add(movie_id)
+        self.terms_by_movie[movie_id] = terms
+
+    def remove(self, movie_id: int):
+        for term in self.terms_by_movie.pop(movie_id, ()):
+            ids = self.postings.get(term)
+            if ids is None:
+                continue
+            ids.discard(movie_id)
+            if not ids:
+                del self.postings[term]
+
+    def clear(self):
+        self.postings = {}
+        self.terms_by_movie = {}
+
+    # catalog events, see events.py
+    def added(self, movies: list):
+        for movie in movies:
+            self.add(movie)
+
+    def removed(self, movie_ids: list):
+        for movie_id in movie_ids:
+            self.remove(movie_id)
+
+    def cleared(self):
+        self.clear()
+
+    # rebuild the whole index from the SQLite database
+    def build(self, db: Session):
+        fresh = SearchIndex()
+        for movie in models.in_id_ranges(models.with_details(db.query(models.Movie)), models.Movie.id, 1000):
+            fresh.add(movie)
+        events.replace_state(self, fresh)
+
+    # the same index from the search terms of the catalog snapshot (snapshot.py)
+    def load(self, snapshot):
+        fresh = SearchIndex()
+        terms, offsets, indices = snapshot.string_lists("terms")
+        offsets, indices = offsets.tolist(), indices.tolist()
+        for slot, movie_id in enumerate(snapshot.ids.tolist()):
+            fresh.add_terms(movie_id, {terms[index] for index in indices[offsets[slot]:offsets[slot + 1]]})
+        events.replace_state(self, fresh)
+
+    # ids of the movies matching the term, sorted so results are stable
+    def lookup(self, term: str):
+        return sorted(self.postings.get(normalize(term), ()))
+
+movie_index = events.subscribe(SearchIndex())
@@ -0,0 +1,203 @@
+import threading
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy.orm import Session
+
+from . import events, models
+
+# "more like this": cosine similarity of TF-IDF weighted genre / keyword / actor / director features
+# - one sparse row per movie (L2 normalized), built from the join tables, so no JSON is decoded
+# - neighbours are computed for batches of movies with one sparse matrix product and cached per movie
+# - new movies are appended as rows and offered to the cached neighbour lists they beat;
+#   removed movies are zeroed; after REBUILD_FRACTION changes the weights are recomputed
+#   (document frequencies drift) and the cache is emptied
+
+FIELD_WEIGHTS = {"genre": 1.0, "keywords": 1.5, "actors": 1.0, "directors": 2.0}
+TOP_K = 20
+BATCH_NONZEROS = 20_000_000 # size of a batch product, in similarity entries
+REBUILD_FRACTION = 0.2
+
+def movie_features(movie: models.Movie):
+    return {(field, value) for field in FIELD_WEIGHTS for value in movie.get_list_field(field) if value}
+
+class SimilarMovies:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self.columns = {} # (field, value) -> column
+        self.column_weights = [] # field weight of each column
+        self.df = np.zeros(0) # number of live movies having each column
+        self.row_ids = [] # row -> movie id, None once removed
+        self.row_columns = [] # row -> columns of the movie
+        self.row_of = {} # movie id -> row
+        self.matrix = sparse.csr_matrix((0, 0))
+        self.neighbours = {} # movie id -> [(score, movie id), ...], best first
+        self.kth = np.zeros(0) # row -> lowest cached neighbour score (inf: not cached, 0: fewer than TOP_K)
+        self.changes = 0
+
+    def column_list(self, features: set):
+        columns = []
+        for feature in features:
+            column = self.columns.get(feature)
+            if column is None:
+                column = self.columns[feature] = len(self.columns)
+                self.column_weights.append(FIELD_WEIGHTS[feature[0]])
+            columns.append(column)
+        if len(self.df) < len(self.columns):
+            self.df = np.concatenate([self.df, np.zeros(len(self.columns) - len(self.df))])
+        return np.array(sorted(columns), dtype=np.int64)
+
+    # normalized TF-IDF rows for lists of columns
+    def weighted_rows(self, rows: list):
+        live = max(len(self.row_of), 1)
+        idf = np.log((1 + live) / (1 + self.df)) + 1
+        weights = np.asarray(self.column_weights) * idf
+        lengths = np.array([len(columns) for columns in rows], dtype=np.int64)
+        indices = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        data = weights[indices] if len(indices) else np.zeros(0)
+        row_numbers = np.repeat(np.arange(len(rows)), lengths)
+        norms = np.sqrt(np.bincount(row_numbers, data ** 2, minlength=len(rows)))
+        data = data / np.where(norms > 0, norms, 1)[row_numbers]
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(rows), len(self.columns)))
+
+    def rebuild(self):
+        self.matrix = self.weighted_rows([columns if movie_id is not None else np.zeros(0, dtype=np.int64)
+                                          for movie_id, columns in zip(self.row_ids, self.row_columns)])
+        self.neighbours = {}
+        self.kth = np.full(len(self.row_ids), np.inf)
+        self.changes = 0
+
+    def build(self, db: Session):
+        features = {movie_id: set() for (movie_id,) in models.in_id_ranges(db.query(models.Movie.id), models.Movie.id)}
+        for movie_id, genre in models.in_id_ranges(db.query(models.MovieGenre.movie_id, models.MovieGenre.genre), models.MovieGenre.movie_id):
+            features.setdefault(movie_id, set()).add(("genre", genre))
+        for movie_id, keyword in models.in_id_ranges(db.query(models.MovieKeyword.movie_id, models.MovieKeyword.keyword), models.MovieKeyword.movie_id):
+            features.setdefault(movie_id, set()).add(("keywords", keyword))
+        people = db.query(models.MoviePerson.movie_id, models.MoviePerson.role, models.MoviePerson.name) \
+            .filter(models.MoviePerson.role.in_(["director", "actor"]))
+        for movie_id, role, name in models.in_id_ranges(people, models.MoviePerson.movie_id):
+            features.setdefault(movie_id, set()).add((role + "s", name))
+        fresh = SimilarMovies()
+        for movie_id in sorted(features):
+            fresh.append_row(movie_id, features[movie_id])
+        fresh.rebuild()
+        events.replace_state(self, fresh)
+
+    def append_row(self, movie_id: int, features: set):
+        columns = self.column_list(features)
+        self.df[columns] += 1
+        self.row_of[movie_id] = len(self.row_ids)
+        self.row_ids.append(movie_id)
+        self.row_columns.append(columns)
+
+    def remove_row(self, movie_id: int):
+        row = self.row_of.pop(movie_id, None)
+        if row is None:
+            return
+        self.df[self.row_columns[row]] -= 1
+        self.row_ids[row] = None
+        self.row_columns[row] = np.zeros(0, dtype=np.int64)
+        start, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        self.matrix.data[start:end] = 0
+        self.kth[row] = np.inf
+        self.neighbours.pop(movie_id, None)
+        self.changes += 1
+
+    # catalog events, see events.py
+    def added(self, movies: list):
+        with self.lock:
+            for movie in movies:
+                self.remove_row(movie.id)
+            first = len(self.row_ids)
+            for movie in movies:
+                self.append_row(movie.id, movie_features(movie))
+            if self.changes + len(movies) > REBUILD_FRACTION * len(self.row_of):
+                self.rebuild()
+                return
+            new = self.weighted_rows(self.row_columns[first:])
+            self.matrix.resize((first, len(self.columns)))
+            self.matrix = sparse.vstack([self.matrix, new], format="csr")
+            self.kth = np.concatenate([self.kth, np.full(len(movies), np.inf)])
+            self.changes += len(movies)
+            self.offer(new, first)
+
+    # offer the new rows to the cached neighbour lists they get into
+    def offer(self, new: sparse.csr_matrix, first: int):
+        scores = (self.matrix @ new.T).tocsc()
+        for column in range(new.shape[0]):
+            movie_id = self.row_ids[first + column]
+            start, end = scores.indptr[column], scores.indptr[column + 1]
+            rows, values = scores.indices[start:end], scores.data[start:end]
+            better = (values > self.kth[rows]) & (rows != first + column)
+            for row, score in zip(rows[better], values[better]):
+                neighbours = [item for item in self.neighbours[self.row_ids[row]] if item[1] != movie_id]
+                self.neighbours[self.row_ids[row]] = neighbours
+                neighbours.append((float(score), movie_id))
+                neighbours.sort(key=lambda item: (-item[0], item[1]))
+                del neighbours[TOP_K:]
+                self.kth[row] = neighbours[-1][0] if len(neighbours) >= TOP_K else 0
+
+    def removed(self, movie_ids: list):
+        with self.lock:
+            for movie_id in movie_ids:
+                self.remove_row(movie_id)
+
+    def cleared(self):
+        with self.lock:
+            self.clear()
+
+    # neighbours of the movies in rows, one sparse product for the batch
+    def compute(self, rows: list):
+        scores = (self.matrix[rows] @ self.matrix.T).tocsr()
+        for position, row in enumerate(rows):
+            start, end = scores.indptr[position], scores.indptr[position + 1]
+            indices, values = scores.indices[start:end], scores.data[start:end]
+            keep = (indices != row) & (values > 0)
+            indices, values = indices[keep], values[keep]
+            if len(values) > TOP_K:
+                best = np.argpartition(-values, TOP_K)[:TOP_K]
+                indices, values = indices[best], values[best]
+            neighbours = sorted(((float(score), self.row_ids[index]) for index, score in zip(indices, values)),
+                                key=lambda item: (-item[0], item[1]))
+            self.neighbours[self.row_ids[row]] = neighbours
+            self.kth[row] = neighbours[-1][0] if len(neighbours) >= TOP_K else 0
+
+    # fill the cache for every movie, in batches; the lock is released between batches
+    def warm(self):
+        batch_size = max(1, BATCH_NONZEROS // max(len(self.row_ids), 1))
+        position = 0
+        while True:
+            with self.lock:
+                rows = [row for row in range(position, min(position + batch_size, len(self.row_ids)))
+                        if self.row_ids[row] is not None and self.row_ids[row] not in self.neighbours]
+                if position >= len(self.row_ids):
+                    return
+                if rows:
+                    self.compute(rows)
+            position += batch_size
+
+    # ids of the movies most similar to movie_id, best first; None for an unknown movie
+    def lookup(self, movie_id: int, limit: int = 10):
+        limit = max(1, min(limit, TOP_K))
+        with self.lock:
+            row = self.row_of.get(movie_id)
+            if row is None:
+                return None
+            neighbours = self.neighbours.get(movie_id)
+            if neighbours is not None:
+                live = [item for item in neighbours if item[1] in self.row_of]
+                # removed neighbours may have made room for movies that are not in the list
+                if len(live) < len(neighbours) and len(neighbours) >= TOP_K and len(live) < limit:
+                    neighbours = None
+                else:
+                    neighbours = live
+            if neighbours is None:
+                self.compute([row])
+                neighbours = self.neighbours[movie_id]
+            return [neighbour_id for score, neighbour_id in neighbours[:limit]]
+
+similar_movies = events.subscribe(SimilarMovies())
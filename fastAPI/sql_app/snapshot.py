@@ -0,0 +1,225 @@
+import datetime
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+from . import models
+from .database import SessionLocal, engine
+from .render_cache import render
+from .search_index import movie_terms
+
+# read-only catalog snapshot shared by the uvicorn workers
+# one file, mapped with mmap by every worker, so its pages are shared through the page cache:
+#   header | metadata (JSON, with the position, type and length of each array) | arrays | records
+# arrays, one entry per movie, sorted by id: ids int64, release date ordinals int32 (0: unknown),
+# dated uint8 (openDate is not None), record offsets uint64[n + 1]; the genres and the search terms
+# of the movies as lists of strings: a JSON table of the distinct strings (uint8) and, per movie,
+# offsets uint32[n + 1] into the table indices uint32
+# records are the movies' JSON as sent to clients (render_cache.render)
+# the records back the render cache, the ids and ordinals the screening partitions (screening.py);
+# a worker loads its filter bitsets, facet counts and search index from the arrays instead of
+# SQLite (main2.build_search_index); the autocomplete tries and the similarity matrix are still
+# built from SQLite, and every structure is still held by each worker
+# the snapshot records the state (inode, size, mtime) of the database file it was built from and
+# is only used while the database file is unchanged; after a write it is rebuilt in the background
+# (one worker at a time, through a lock file) and every worker switches to the new file on its next
+# read, the file being replaced with os.replace
+# build it with `python -m sql_app.snapshot` or POST /snapshot/; without the file nothing changes
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = os.environ.get("SNAPSHOT_FILE", "./sql_app.snapshot")
+REBUILD_DELAY = float(os.environ.get("SNAPSHOT_REBUILD_DELAY", "5")) # seconds after a write; 0: no rebuilds
+
+MAGIC = b"SMDBSNAP"
+VERSION = 3
+HEADER = struct.Struct("<8sII") # magic, version, metadata length
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+def database_state():
+    try:
+        stat = os.stat(engine.url.database)
+    except (OSError, TypeError):
+        return None
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+def padding(position: int):
+    return b"\0" * (-position % 8)
+
+# lists of strings, one per movie -> (name_table, name_offsets, name_indices) arrays
+def string_lists(name: str, lists: list):
+    table, offsets, indices = {}, [0], []
+    for values in lists:
+        indices.extend(table.setdefault(value, len(table)) for value in values)
+        offsets.append(len(indices))
+    table_bytes = json.dumps(list(table), ensure_ascii=False).encode("utf-8")
+    return [(name + "_table", np.frombuffer(table_bytes, dtype=np.uint8)),
+            (name + "_offsets", np.array(offsets, dtype=np.uint32)),
+            (name + "_indices", np.array(indices, dtype=np.uint32))]
+
+def build_snapshot(path: str = SNAPSHOT_FILE):
+    with open(path + ".lock", "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None # another worker is building it
+        state = database_state()
+        ids, ordinals, dated, offsets = [], [], [], [0]
+        genres, terms = [], []
+        records_path = path + ".records"
+        db = SessionLocal()
+        try:
+            with open(records_path, "wb") as records:
+                query = models.with_details(db.query(models.Movie)).order_by(models.Movie.id)
+                for movie in query.yield_per(1000):
+                    record = render(movie)
+                    records.write(record)
+                    offsets.append(offsets[-1] + len(record))
+                    ids.append(movie.id)
+                    open_date = models.parse_open_date(movie.openDate)
+                    ordinals.append(open_date.toordinal() if open_date else 0)
+                    dated.append(movie.openDate is not None)
+                    genres.append(movie.get_list_field("genre"))
+                    terms.append(sorted(movie_terms(movie)))
+        finally:
+            db.close()
+
+        arrays = [("ids", np.array(ids, dtype=np.int64)),
+                  ("ordinals", np.array(ordinals, dtype=np.int32)),
+                  ("dated", np.array(dated, dtype=np.uint8)),
+                  ("offsets", np.array(offsets, dtype=np.uint64)),
+                  *string_lists("genres", genres),
+                  *string_lists("terms", terms)]
+        meta = {"count": len(ids), "database": state, "arrays": {},
+                "built_at": datetime.datetime.now().isoformat(timespec="seconds")}
+        # positions of the arrays, computed with a metadata block of a fixed size
+        meta_length = 4096
+        position = HEADER.size + meta_length
+        for name, array in arrays:
+            meta["arrays"][name] = [position, array.dtype.str, len(array)]
+            position += array.nbytes + len(padding(array.nbytes))
+        meta["records"] = position
+        meta_bytes = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+        if len(meta_bytes) > meta_length:
+            raise ValueError("snapshot metadata does not fit its block")
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(meta_bytes)))
+            f.write(meta_bytes.ljust(meta_length, b"\0"))
+            for name, array in arrays:
+                f.write(array.tobytes())
+                f.write(padding(array.nbytes))
+            with open(records_path, "rb") as records:
+                while True:
+                    chunk = records.read(1 << 20)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.remove(records_path)
+        os.replace(tmp_path, path)
+        return {"movies": len(ids), "bytes": os.path.getsize(path), "built_at": meta["built_at"]}
+
+# one mapped snapshot file
+class Snapshot:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, meta_length = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} catalog snapshot")
+        self.meta = json.loads(self.buffer[HEADER.size:HEADER.size + meta_length])
+        self.arrays = {name: np.frombuffer(self.buffer, dtype=dtype, count=count, offset=position)
+                       for name, (position, dtype, count) in self.meta["arrays"].items()}
+        self.ids = self.arrays["ids"]
+        self.ordinals = self.arrays["ordinals"]
+        self.dated = self.arrays["dated"].view(bool)
+        self.offsets = self.arrays["offsets"]
+
+    # release years (0: unknown release date)
+    def years(self):
+        days = (self.ordinals.astype(np.int64) - EPOCH_ORDINAL).astype("datetime64[D]")
+        return np.where(self.ordinals > 0, days.astype("datetime64[Y]").astype(np.int64) + 1970, 0)
+
+    # (distinct strings, offsets[n + 1], indices) of per movie lists of strings: the strings of
+    # the movie in slot i are table[indices[offsets[i]:offsets[i + 1]]]
+    def string_lists(self, name: str):
+        table = json.loads(self.arrays[name + "_table"].tobytes())
+        return table, self.arrays[name + "_offsets"], self.arrays[name + "_indices"]
+
+    # movie id -> JSON record, for the ids in the snapshot
+    def records(self, movie_ids: list):
+        if not len(movie_ids) or not len(self.ids):
+            return {}
+        wanted = np.asarray(movie_ids, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, wanted), len(self.ids) - 1)
+        found = self.ids[positions] == wanted
+        start = self.meta["records"]
+        return {int(movie_id): self.buffer[start + int(self.offsets[position]):start + int(self.offsets[position + 1])]
+                for movie_id, position in zip(wanted[found], positions[found])}
+
+# the snapshot of SNAPSHOT_FILE that matches the database, reopened when the file is replaced
+class SnapshotReader:
+    def __init__(self, path: str = SNAPSHOT_FILE):
+        self.path = path
+        self.file_key = None
+        self.snapshot = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def current(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        file_key = (stat.st_ino, stat.st_mtime_ns)
+        snapshot = self.snapshot
+        if file_key != self.file_key:
+            with self.lock:
+                if file_key != self.file_key:
+                    try:
+                        self.snapshot = Snapshot(self.path)
+                    except (OSError, ValueError):
+                        logger.exception("cannot open the catalog snapshot %s", self.path)
+                        self.snapshot = None
+                    self.file_key = file_key
+                snapshot = self.snapshot
+        if snapshot is None or snapshot.meta["database"] != database_state():
+            self.schedule_rebuild()
+            return None
+        return snapshot
+
+    def records(self, movie_ids: list):
+        snapshot = self.current()
+        return snapshot.records(movie_ids) if snapshot is not None else {}
+
+    def schedule_rebuild(self):
+        if REBUILD_DELAY <= 0:
+            return
+        with self.lock:
+            if self.timer is not None and self.timer.is_alive():
+                return
+            self.timer = threading.Timer(REBUILD_DELAY, self.rebuild)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def rebuild(self):
+        try:
+            report = build_snapshot(self.path)
+            if report is not None:
+                logger.info("catalog snapshot rebuilt: %s", report)
+        except Exception:
+            logger.exception("catalog snapshot rebuild failed")
+
+snapshot_reader = SnapshotReader()
+
+if __name__ == "__main__":
+    print(build_snapshot())
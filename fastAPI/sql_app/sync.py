@@ -0,0 +1,236 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import os
+import time
+
+from pydantic import ValidationError
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from . import crud, database, dataverse, models, schemas
+from .database import SessionLocal
+
+# incremental Dataverse -> SQLite sync
+# - pages through the "movies" subtree, oldest datasets first, saving the next page in sync_checkpoint
+# - the SHA-1 of each dataset's description tells new, changed and unchanged movies apart
+# - every page is applied in its own transaction; datasets not seen by a complete run and missing
+#   from a final listing pass are removed
+# run it with `python -m sql_app.sync`, or in the app every SYNC_INTERVAL seconds; the pages applied
+# by the command bump the catalog generation (database.py), so a running app rebuilds its in-memory
+# structures, drops its rendered movies and changes its ETags on its next request
+
+logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL = float(os.environ.get("SYNC_INTERVAL", "0")) # 0: no in-process schedule
+PAGE_SIZE = 100
+SEARCH_PARAMS = {"q": "*", "subtree": "movies", "type": "dataset", "sort": "date", "order": "asc"}
+
+last_report = None
+lock = asyncio.Lock()
+
+def description_hash(description: str):
+    return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+def new_report(run_id: int):
+    return {"run_id": run_id, "pages": 0, "seen": 0, "inserted": 0, "updated": 0, "unchanged": 0,
+            "removed": 0, "invalid": 0, "seconds": 0.0}
+
+# current checkpoint, or a new run starting at the first page
+def start_run(db):
+    checkpoint = db.get(models.SyncCheckpoint, 1)
+    if checkpoint is None or checkpoint.next_start is None:
+        last_run = db.query(func.max(models.SyncState.seen_run)).scalar() or 0
+        if checkpoint is None:
+            checkpoint = models.SyncCheckpoint(id=1)
+            db.add(checkpoint)
+        checkpoint.run_id = max(last_run, checkpoint.run_id or 0) + 1
+        checkpoint.next_start = 0
+        checkpoint.started_at = datetime.datetime.now().isoformat(timespec="seconds")
+        db.commit()
+    return checkpoint.run_id, checkpoint.next_start
+
+# apply the datasets of one page and move the checkpoint to next_start, in one transaction
+def apply_page(db, run_id: int, items: list, next_start: int, report: dict):
+    datasets = {}
+    for item in items:
+        if item.get("type") == "dataset" and item.get("description"):
+            datasets[item.get("global_id") or item["name"]] = item["description"]
+    report["seen"] += len(datasets)
+
+    states = {state.global_id: state for state in
+              db.query(models.SyncState).filter(models.SyncState.global_id.in_(list(datasets)))}
+    # a linked movie whose row is gone is written again, even when its dataset is unchanged
+    present = {movie_id for (movie_id,) in
+               db.query(models.Movie.id).filter(models.Movie.id.in_({state.movie_id for state in states.values()}))}
+    changed = {} # global_id -> (hash, movie)
+    for global_id, description in datasets.items():
+        digest = description_hash(description)
+        state = states.get(global_id)
+        if state is not None and state.description_hash == digest and state.movie_id in present:
+            report["unchanged"] += 1
+            continue
+        try:
+            changed[global_id] = (digest, schemas.Movie(**json.loads(description)))
+        except (ValueError, ValidationError):
+            report["invalid"] += 1
+
+    added_ids = []
+    new_movies = {}
+    for global_id, (digest, data) in changed.items():
+        state = states.get(global_id)
+        if state is not None:
+            try:
+                # the new fingerprint may collide with another movie
+                with db.begin_nested():
+                    crud.replace_movie(db, state.movie_id, data)
+            except IntegrityError:
+                report["invalid"] += 1
+                continue
+            state.description_hash = digest
+            added_ids.append(state.movie_id)
+            report["updated"] += 1
+        else:
+            new_movies[global_id] = (digest, data)
+
+    if new_movies:
+        # datasets already in the catalog (e.g. uploaded before) are linked to their movie
+        keys = {global_id: crud.fingerprint(data) for global_id, (digest, data) in new_movies.items()}
+        existing = crud.movie_ids_by_fingerprint(db, keys.values())
+        to_insert = [data for global_id, (digest, data) in new_movies.items() if keys[global_id] not in existing]
+        if to_insert:
+            batch_report = {"inserted": 0, "skipped": 0}
+            added_ids += crud.insert_movie_batch(db, to_insert, set(), batch_report)
+            report["inserted"] += batch_report["inserted"]
+            existing = crud.movie_ids_by_fingerprint(db, keys.values())
+        written = set(added_ids)
+        for global_id, (digest, data) in new_movies.items():
+            movie_id = existing[keys[global_id]]
+            if movie_id not in written:
+                crud.replace_movie(db, movie_id, data)
+                written.add(movie_id)
+                added_ids.append(movie_id)
+                report["updated"] += 1
+            db.add(models.SyncState(global_id=global_id, description_hash=digest, movie_id=movie_id))
+        db.flush()
+
+    if datasets:
+        db.query(models.SyncState).filter(models.SyncState.global_id.in_(list(datasets))) \
+            .update({"seen_run": run_id}, synchronize_session=False)
+    db.query(models.SyncCheckpoint).filter(models.SyncCheckpoint.id == 1) \
+        .update({"next_start": next_start}, synchronize_session=False)
+    crud.commit_changes(db, added_ids, [])
+    report["pages"] += 1
+
+def unseen_states(db, run_id: int):
+    return db.query(models.SyncState).filter(
+        (models.SyncState.seen_run == None) | (models.SyncState.seen_run < run_id))
+
+def count_unseen(db, run_id: int):
+    return unseen_states(db, run_id).count()
+
+# end of a complete run: remove the datasets that were not seen and are not in listed (the listing
+# of list_global_ids; None: nothing is removed) and their movies, clear the checkpoint
+# several datasets with the same fingerprint share one movie, which is kept while one of them is left
+def finish_run(db, run_id: int, report: dict, listed):
+    # an empty listing is more likely an upstream problem than an empty catalog
+    if report["seen"] == 0 or listed is None:
+        removed = []
+    else:
+        removed = [state for state in unseen_states(db, run_id) if state.global_id not in listed]
+    for state in removed:
+        db.delete(state)
+    db.flush()
+    linked = {state.movie_id for state in removed}
+    if linked:
+        linked -= {movie_id for (movie_id,) in
+                   db.query(models.SyncState.movie_id).filter(models.SyncState.movie_id.in_(linked))}
+    movie_ids = sorted(linked)
+    crud.delete_movies(db, movie_ids)
+    db.query(models.SyncCheckpoint).filter(models.SyncCheckpoint.id == 1) \
+        .update({"next_start": None}, synchronize_session=False)
+    crud.commit_changes(db, [], movie_ids)
+    report["removed"] = len(movie_ids)
+
+# global ids of every dataset of the listing, read in a pass of its own before anything is removed:
+# the run pages by offset and may have resumed hours later, so a dataset removed upstream meanwhile
+# shifts the later pages and an unrelated dataset is never seen; None when total_count changed
+# during the pass, the removals then wait for the next run
+async def list_global_ids(client: dataverse.DataverseClient, page_size: int = PAGE_SIZE):
+    listed = set()
+    start = 0
+    total_count = None
+    while True:
+        page = await client.fetch_page(SEARCH_PARAMS, start, page_size)
+        if total_count is not None and page["total_count"] != total_count:
+            return None
+        total_count = page["total_count"]
+        for item in page["items"]:
+            if item.get("type") == "dataset":
+                listed.add(item.get("global_id") or item["name"])
+        start += page_size
+        if start >= total_count:
+            return listed
+
+# runs function(db, *args) in a session of its own, holding the write lock (database.write_lock)
+def in_session(function, *args):
+    with database.write_lock:
+        db = SessionLocal()
+        try:
+            return function(db, *args)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+# one sync run (resuming an interrupted one); returns the report with timings and row counts
+async def run_sync(client: dataverse.DataverseClient = None, page_size: int = PAGE_SIZE):
+    global last_report
+    client = client or dataverse.client
+    async with lock:
+        began = time.monotonic()
+        run_id, start = await asyncio.to_thread(in_session, start_run)
+        report = new_report(run_id)
+        report["resumed_at"] = start
+        while True:
+            page = await client.fetch_page(SEARCH_PARAMS, start, page_size)
+            start += page_size
+            await asyncio.to_thread(in_session, apply_page, run_id, page["items"], start, report)
+            if start >= page["total_count"]:
+                break
+        listed = set()
+        if await asyncio.to_thread(in_session, count_unseen, run_id):
+            listed = await list_global_ids(client, page_size)
+            if listed is None:
+                logger.warning("sync run %s: the listing changed while it was checked, nothing removed", run_id)
+        await asyncio.to_thread(in_session, finish_run, run_id, report, listed)
+        report["seconds"] = round(time.monotonic() - began, 3)
+        logger.info("sync run %s: %s", run_id, report)
+        last_report = report
+        return report
+
+# in-process schedule, started by the app when SYNC_INTERVAL is set
+async def run_forever(interval: float = SYNC_INTERVAL):
+    while True:
+        try:
+            await run_sync()
+        except Exception:
+            logger.exception("sync run failed")
+        await asyncio.sleep(interval)
+
+if __name__ == "__main__":
+    from . import migrations
+
+    logging.basicConfig(level=logging.INFO)
+    migrations.migrate()
+
+    async def main():
+        try:
+            return await run_sync()
+        finally:
+            await dataverse.client.aclose()
+
+    print(json.dumps(asyncio.run(main()), ensure_ascii=False))
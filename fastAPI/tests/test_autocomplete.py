@@ -0,0 +1,48 @@
+import random
+
+import pytest
+
+from benchmarks.generate import movies
+from sql_app import crud, migrations, models
+from sql_app.autocomplete import Autocomplete
+from sql_app.database import SessionLocal
+
+# the top lists computed bottom-up by Autocomplete.build have to give the same suggestions as the
+# ones kept up to date movie by movie (added / removed events)
+
+QUERIES = ["사", "사랑", "비밀 가", "ㅅ", "ㅅㄹ", "ㄱㅈ", "김", "이", "night", "the", "city l", "moon sea 1", "가", "ㅂ"]
+
+@pytest.fixture(scope="module")
+def db():
+    migrations.migrate()
+    session = SessionLocal()
+    crud.bulk_insert_movies(session, movies(600, seed=31))
+    yield session
+    session.close()
+
+def lookups(autocomplete: Autocomplete):
+    return {q: autocomplete.lookup(q, 10) for q in QUERIES}
+
+def built(db):
+    autocomplete = Autocomplete()
+    autocomplete.build(db)
+    return autocomplete
+
+def test_build_matches_incremental(db):
+    all_movies = models.with_details(db.query(models.Movie)).all()
+    incremental = Autocomplete()
+    incremental.added(all_movies)
+    assert lookups(built(db)) == lookups(incremental)
+
+def test_build_matches_after_removals(db):
+    rng = random.Random(3)
+    all_movies = models.with_details(db.query(models.Movie)).all()
+    removed = rng.sample(all_movies, len(all_movies) // 3)
+    incremental = built(db)
+    incremental.removed([movie.id for movie in removed])
+    incremental.added(removed[:20])
+
+    kept = [movie for movie in all_movies if movie not in removed[20:]]
+    expected = Autocomplete()
+    expected.added(kept)
+    assert lookups(incremental) == lookups(expected)
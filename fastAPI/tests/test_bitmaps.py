@@ -0,0 +1,63 @@
+import random
+
+import pytest
+
+from benchmarks.generate import movies
+from sql_app import crud, database, migrations, models, schemas
+from sql_app.bitmaps import filter_engine
+from sql_app.database import SessionLocal
+
+# filter_engine.search (in-memory bitsets) has to give the same pages as crud.searchquery (SQL),
+# also after movies are deleted and replaced through crud
+
+GENRES = [genre.value for genre in schemas.Genre]
+
+@pytest.fixture(scope="module")
+def db():
+    migrations.migrate()
+    session = SessionLocal()
+    crud.bulk_insert_movies(session, movies(600, seed=7))
+    build = lambda *changes: filter_engine.build(session)
+    database.check_generation(build, build, wait=True)
+    yield session
+    session.close()
+
+def random_filters(rng: random.Random):
+    return dict(genres=rng.sample(GENRES, rng.randint(0, 3)) or None,
+                openyear=rng.choice([None, 0, 1995, 2010, 2020]),
+                endyear=rng.choice([None, 9999, 2000, 2015, 2024]),
+                page=rng.randint(1, 4),
+                per_page=rng.choice([5, 15, 40]),
+                q=rng.choice([None, None, "사랑", "비밀 가"]))
+
+def assert_same_results(db, rng: random.Random, rounds: int = 100):
+    for _ in range(rounds):
+        filters = random_filters(rng)
+        expected = crud.searchquery(db, **filters)
+        assert filter_engine.search(db, **filters) == expected, filters
+        if expected["nextCursor"] is not None:
+            filters.update(page=1, cursor=expected["nextCursor"])
+            assert filter_engine.search(db, **filters) == crud.searchquery(db, **filters), filters
+
+def test_search_matches_searchquery(db):
+    assert_same_results(db, random.Random(1))
+
+def test_search_after_deletes_and_replacements(db):
+    rng = random.Random(2)
+    movie_ids = [movie_id for (movie_id,) in db.query(models.Movie.id)]
+    rng.shuffle(movie_ids)
+
+    removed = movie_ids[:200]
+    crud.delete_movies(db, removed)
+    crud.commit_changes(db, [], removed)
+    assert_same_results(db, rng)
+
+    replaced = movie_ids[200:240]
+    for movie_id in replaced:
+        movie = models.with_details(db.query(models.Movie)).filter(models.Movie.id == movie_id).one()
+        data = schemas.Movie(**{field: getattr(movie, field) for field in schemas.Movie.model_fields})
+        data.genre = rng.sample(GENRES, rng.randint(1, 2))
+        data.openDate = rng.choice(["1999.03.01", "2021.12.24", ""])
+        crud.replace_movie(db, movie_id, data)
+    crud.commit_changes(db, replaced, [])
+    assert_same_results(db, rng)
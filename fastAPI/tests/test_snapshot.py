@@ -0,0 +1,61 @@
+import pytest
+
+from benchmarks.generate import movies
+from sql_app import crud, migrations
+from sql_app.bitmaps import FilterEngine, unpack
+from sql_app.database import SessionLocal
+from sql_app.facets import FacetCounts
+from sql_app.search_index import SearchIndex
+from sql_app.snapshot import Snapshot, build_snapshot
+
+# the search index, facet counts and filter bitsets loaded from the catalog snapshot have to be
+# the ones built from SQLite
+
+@pytest.fixture(scope="module")
+def db():
+    migrations.migrate()
+    session = SessionLocal()
+    crud.bulk_insert_movies(session, movies(400, seed=41))
+    yield session
+    session.close()
+
+@pytest.fixture(scope="module")
+def snapshot(db, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("snapshot") / "catalog.snapshot")
+    build_snapshot(path)
+    return Snapshot(path)
+
+def both(structure_class, db, snapshot):
+    built, loaded = structure_class(), structure_class()
+    built.build(db)
+    loaded.load(snapshot)
+    return built, loaded
+
+def test_search_index(db, snapshot):
+    built, loaded = both(SearchIndex, db, snapshot)
+    assert loaded.postings == built.postings
+    assert loaded.terms_by_movie == built.terms_by_movie
+
+def test_facet_counts(db, snapshot):
+    built, loaded = both(FacetCounts, db, snapshot)
+    assert loaded.facets() == built.facets()
+    assert list(loaded.facets()["genres"]) == list(built.facets()["genres"])
+    for genres in (["액션"], ["드라마", "코미디"]):
+        assert loaded.facets(genres, 1995, 2015) == built.facets(genres, 1995, 2015)
+
+def slots_by_id(engine: FilterEngine, words):
+    flags = unpack(words, engine.size)
+    return {int(movie_id) for movie_id, flag in zip(engine.ids[:engine.size], flags) if flag}
+
+def test_filter_bitsets(db, snapshot):
+    built, loaded = both(FilterEngine, db, snapshot)
+    assert loaded.slot_of.keys() == built.slot_of.keys()
+    for name in ("live", "dated"):
+        assert slots_by_id(loaded, getattr(loaded, name)) == slots_by_id(built, getattr(built, name))
+    for name in ("genres", "years"):
+        built_bitsets, loaded_bitsets = getattr(built, name), getattr(loaded, name)
+        assert loaded_bitsets.keys() == built_bitsets.keys()
+        for value in built_bitsets:
+            assert slots_by_id(loaded, loaded_bitsets[value]) == slots_by_id(built, built_bitsets[value])
+    order = lambda engine: engine.ids[engine.sorted_slots()].tolist()
+    assert order(loaded) == order(built)
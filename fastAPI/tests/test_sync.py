@@ -0,0 +1,124 @@
+import asyncio
+
+import httpx
+import pytest
+
+from benchmarks.generate import movies
+from sql_app import crud, dataverse, migrations, models, sync
+from sql_app.database import SessionLocal
+
+# sync runs against a Dataverse served by httpx.MockTransport: datasets removed upstream, an
+# interrupted run resumed from its checkpoint, datasets sharing one movie through their fingerprint
+
+class FakeDataverse:
+    def __init__(self):
+        self.datasets = {} # global_id -> description, in listing order
+        self.fail_after = None # pages served before the next request fails
+        self.pages = 0
+
+    def handler(self, request: httpx.Request):
+        if self.fail_after is not None and self.pages >= self.fail_after:
+            return httpx.Response(400)
+        self.pages += 1
+        start = int(request.url.params["start"])
+        per_page = int(request.url.params["per_page"])
+        items = [{"type": "dataset", "global_id": global_id, "name": global_id, "description": description}
+                 for global_id, description in list(self.datasets.items())[start:start + per_page]]
+        return httpx.Response(200, json={"data": {"total_count": len(self.datasets), "items": items}})
+
+    def run(self, page_size: int = 2):
+        client = dataverse.DataverseClient("http://dataverse.test", transport=httpx.MockTransport(self.handler), retries=0)
+        async def run():
+            try:
+                return await sync.run_sync(client, page_size)
+            finally:
+                await client.aclose()
+        return asyncio.run(run())
+
+@pytest.fixture
+def upstream():
+    migrations.migrate()
+    db = SessionLocal()
+    db.query(models.SyncState).delete()
+    db.query(models.SyncCheckpoint).delete()
+    db.commit()
+    db.close()
+    return FakeDataverse()
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    yield session
+    session.close()
+
+def sample_movies(count: int, seed: int):
+    found = list(movies(count, seed=seed))
+    for data in found:
+        data.title = f"sync {seed} {data.title}"
+    return found
+
+def linked_movie(db, global_id: str):
+    db.expire_all()
+    state = db.get(models.SyncState, global_id)
+    return state and db.get(models.Movie, state.movie_id)
+
+def test_removed_dataset(upstream, db):
+    for number, data in enumerate(sample_movies(5, seed=21)):
+        upstream.datasets[f"doi:{number}"] = data.model_dump_json()
+    report = upstream.run()
+    assert (report["inserted"], report["removed"]) == (5, 0)
+
+    removed_id = db.get(models.SyncState, "doi:3").movie_id
+    del upstream.datasets["doi:3"]
+    report = upstream.run()
+    assert (report["unchanged"], report["removed"]) == (4, 1)
+    assert db.get(models.Movie, removed_id) is None
+    assert all(linked_movie(db, f"doi:{number}") is not None for number in (0, 1, 2, 4))
+
+def test_interrupted_run_resumes(upstream, db):
+    for number, data in enumerate(sample_movies(5, seed=22)):
+        upstream.datasets[f"doi:{number}"] = data.model_dump_json()
+    upstream.fail_after = 1
+    with pytest.raises(dataverse.DataverseError):
+        upstream.run()
+    assert db.query(models.SyncCheckpoint).one().next_start == 2
+
+    upstream.fail_after = None
+    report = upstream.run()
+    assert report["resumed_at"] == 2
+    assert (report["inserted"], report["removed"]) == (3, 0)
+    assert all(linked_movie(db, f"doi:{number}") is not None for number in range(5))
+
+def test_shared_fingerprint(upstream, db):
+    first, other = sample_movies(2, seed=23)
+    copy = first.model_copy(update={"keywords": first.keywords + ["복제"]})
+    upstream.datasets = {"doi:a": first.model_dump_json(), "doi:b": copy.model_dump_json(),
+                         "doi:c": other.model_dump_json()}
+    upstream.run()
+    movie_id = db.get(models.SyncState, "doi:a").movie_id
+    assert db.get(models.SyncState, "doi:b").movie_id == movie_id
+
+    # the movie stays while one of its datasets is left
+    del upstream.datasets["doi:b"]
+    report = upstream.run()
+    assert report["removed"] == 0
+    assert linked_movie(db, "doi:a") is not None
+
+    edited = first.model_copy(update={"runningTimeMinute": "1분"})
+    upstream.datasets["doi:a"] = edited.model_dump_json()
+    assert upstream.run()["updated"] == 1
+    assert linked_movie(db, "doi:a").runningTimeMinute == "1분"
+
+    del upstream.datasets["doi:a"]
+    assert upstream.run()["removed"] == 1
+    assert db.get(models.Movie, movie_id) is None
+
+def test_replace_missing_movie(db):
+    migrations.migrate()
+    data = sample_movies(1, seed=24)[0]
+    movie_id = db.query(models.Movie.id).order_by(models.Movie.id.desc()).limit(1).scalar() or 0
+    movie_id += 100
+    crud.replace_movie(db, movie_id, data)
+    crud.commit_changes(db, [movie_id], [])
+    assert db.get(models.Movie, movie_id).title == data.title
+    assert crud.search_movies(db, data.directors[0])